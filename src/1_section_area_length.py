@@ -3,113 +3,172 @@
 # 1 Feb 2023
 #---------------------------------------
 
-import os
-import json
+import argparse
+import logging
 import pandas as pd
 import numpy as np
-import shapely
-from shapely import affinity
-from shapely.geometry import Polygon, MultiPolygon
+from dataset import load_dataset, derived_path
+from annotation_store import load_contour, open_store, annotation_path, add_annotations_argument
+from geometry_metrics import geometry_metrics
+from incremental_build import (Manifest, manifest_path, code_version, input_hash,
+  run_incremental, atomic_write_csv, add_incremental_argument)
+from run_report import start_run, add_report_arguments
+from specimen_executor import map_specimens, add_workers_argument
 
-data = pd.read_csv("../data/raw/01_cb_data.csv")
-scale = np.array(pd.read_csv("../data/raw/02_scale.csv")["Scale"])
+log = logging.getLogger("1_section_area_length")
 
-def bbox(polys):
-  '''Compute bounding box of a list of polygons
-  Parameters
-  ----------
-  polys : list of shapely.geometry.Polygon
-    List of polygons
-  Returns
-  -------
-  list of float
-    Bounding box of the list of polygons
-  '''
+# source files whose changes invalidate the results of the stage
+STAGE_FILES = [
+  "1_section_area_length.py", "geometry_metrics.py", "annotation_store.py",
+  "convert_polygons_to_shapely_multipolygons.py"]
 
-  b = []
-  for poly in polys:
-    b = [*poly.bounds]
-    if len(b) == 4:
-      break
-  if len(b) == 0:
-    return []
-
-  for poly in polys:
-    bb = [*poly.bounds]
-    if len(bb) == 0:
+def subjects_with_scale():
+  '''Rows and MicroDraw URLs of the subjects with a scale'''
+  data, scale = load_dataset()
+  subjects = []
+  for row in range(len(data)):
+    if scale[row] == 0:
+      log.info("%s no scale", row)
       continue
-    b[0] = min(b[0], bb[0])
-    b[1] = min(b[1], bb[1])
-    b[2] = max(b[2], bb[2])
-    b[3] = max(b[3], bb[3])
-  return b
-
-def convert_polygons_to_shapely_multipolygons(polygons):
-  '''Convert a list of polygons to a shapely multipolygon
+    subjects.append((row, data.iloc[row]["URL"]))
+  return subjects
+
+def load_region_geometries(region, subjects, n_workers=1, annotations=None, report=None):
+  '''Load the sections of a region for a list of subjects
   Parameters
   ----------
-  polygons : list of list of float
-    List of polygons. The first polygon is the exterior, the rest are holes.
+  region : str
+    "cb" for cerebellum or "ctx" for cerebrum
+  subjects : list of tuple
+    row and MicroDraw URL of each subject
+  n_workers : int
+    number of processes used to read JSON annotations
+  annotations : str
+    path of an annotation store. If None, the JSON annotations are read
+  report : run_report.RunReport
+    if provided, reading each JSON annotation is profiled
   Returns
   -------
-  shapely.geometry.MultiPolygon
-    Shapely multipolygon
+  names : list of str
+    names of the subjects that could be loaded
+  geoms : np.array of shapely.geometry.MultiPolygon
+    their sections
   '''
+  if annotations is None:
+    results, _ = map_specimens(
+      load_contour, [(source, region) for _, source in subjects], n_workers,
+      labels=[(row, region, source) for row, source in subjects], report=report)
+    results = [r for r in results if r is not None]
+    geoms = np.empty(len(results), dtype=object)
+    geoms[:] = [r[1] for r in results]
+    return [r[0] for r in results], geoms
 
-  shapely_multipolygon = []
-  for poly in [p[0] for p in polygons]:
-    shapely_polygon = Polygon(poly[0], holes=poly[1:])
-    shapely_multipolygon.append(shapely_polygon)
-  return MultiPolygon(shapely_multipolygon)
+  # build all geometries of the region in bulk from the store
+  store = open_store(annotations)
+  region_range = store.region_range(region)
+  region_geoms = store.geometries(region_range)
+  indices = []
+  for row, source in subjects:
+    try:
+      indices.append(store.find(region, source))
+    except KeyError:
+      log.error("%s not in the annotation store", (row, source))
+  names = [store.name(i) for i in indices]
+  return names, region_geoms[np.array(indices, dtype=int) - region_range.start]
 
-# cerebellum
-cb = []
-for row in range(len(data)):
-  try:
-    if scale[row] == 0:
-      print(row, "no scale")
-      continue
-    source = data.iloc[row]["URL"]
-    dic = json.load(open(f"../data/raw/json/cb/{source.split('/')[-1]}.cb-50%.json", "r", encoding="utf-8"))
-    cb_polys = dic["slice_polygons"]
-    name = dic["name"]
-    sm = convert_polygons_to_shapely_multipolygons(cb_polys)
-    area = sm.area
-    length = sm.length
-    cb.append([name, np.log10(area), np.log10(length)])
-  except BaseException as err:
-    print(row, source, err)
-    raise ValueError(err)
-cb_df = pd.DataFrame({
-  "Log10Area": [r[1] for r in cb],
-  "Log10Length": [r[2] for r in cb]
-})
-# save as csv
-cb_df.index = [r[0] for r in cb]
-cb_df.to_csv(os.path.join("../data/derived/csv/01_cb_area_length.csv"))
-
-# cerebrum
-ctx = []
-for row in range(len(data)):
-  try:
-    if scale[row] == 0:
-      print(row, "no scale")
-      continue
-    source = data.iloc[row]["URL"]
-    dic = json.load(open(f"../data/raw/json/ctx/{source.split('/')[-1]}.ctx-50%.json", "r", encoding="utf-8"))
-    ctx_polys = dic["slice_polygons"]
-    name = dic["name"]
-    sm = convert_polygons_to_shapely_multipolygons(ctx_polys)
-    area = sm.area
-    length = sm.length
-    ctx.append([name, np.log10(area), np.log10(length)])
-  except BaseException as err:
-    print(row, source, err)
-    raise ValueError(err)
-ctx_df = pd.DataFrame({
-  "Log10Area": [r[1] for r in ctx],
-  "Log10Length": [r[2] for r in ctx]
-})
-# save as csv
-ctx_df.index = [r[0] for r in ctx]
-ctx_df.to_csv(os.path.join("../data/derived/csv/02_ctx_area_length.csv"))
+def save_area_length(names, metrics, path):
+  '''Save section areas and lengths as csv'''
+  data_frame = pd.DataFrame({
+    "Log10Area": np.log10(metrics["Area"].to_numpy()),
+    "Log10Length": np.log10(metrics["Length"].to_numpy())
+  })
+  data_frame.index = names
+  atomic_write_csv(data_frame, path)
+
+def compute_area_length_for_all(n_workers=1, annotations=None, metrics_path=None, report=None):
+  '''Compute section areas and lengths of the cerebellum and the cerebrum
+  for all subjects, in one vectorised pass'''
+  subjects = subjects_with_scale()
+  cb_names, cb_geoms = load_region_geometries("cb", subjects, n_workers, annotations, report)
+  ctx_names, ctx_geoms = load_region_geometries("ctx", subjects, n_workers, annotations, report)
+
+  metrics = geometry_metrics(np.concatenate([cb_geoms, ctx_geoms]))
+  cb_metrics = metrics.iloc[:len(cb_geoms)]
+  ctx_metrics = metrics.iloc[len(cb_geoms):]
+
+  save_area_length(cb_names, cb_metrics, derived_path("csv", "01_cb_area_length.csv"))
+  save_area_length(ctx_names, ctx_metrics, derived_path("csv", "02_ctx_area_length.csv"))
+
+  if metrics_path is not None:
+    metrics.insert(0, "Region", ["cb"]*len(cb_geoms) + ["ctx"]*len(ctx_geoms))
+    metrics.index = cb_names + ctx_names
+    atomic_write_csv(metrics, metrics_path)
+
+def section_metrics(source, region, annotations=None):
+  '''Name and geometric measurements of the section of a specimen'''
+  name, geom = load_contour(source, region, annotations)
+  metrics = geometry_metrics([geom]).iloc[0]
+  return {"Name": name, **{k: float(v) for k, v in metrics.items()}}
+
+def compute_area_length_incremental(
+  n_workers=1, annotations=None, metrics_path=None, report=None
+):
+  '''Compute section areas and lengths, only for the specimens whose
+  annotation, data or scale changed since the last run'''
+  data, scale = load_dataset()
+  subjects = subjects_with_scale()
+  version = code_version(STAGE_FILES)
+  tasks, keys, digests = [], [], []
+  for region in ("cb", "ctx"):
+    for row, source in subjects:
+      tasks.append((source, region, annotations))
+      keys.append(f"{region}/{source.split('/')[-1]}")
+      digests.append(input_hash(
+        files=[annotation_path(source, region)],
+        values=[version, data.iloc[row].to_json(), scale[row]]))
+  manifest = Manifest(manifest_path("01_area_length"))
+  results = run_incremental(
+    section_metrics, tasks, keys, digests, manifest, n_workers, report=report)
+
+  columns = geometry_metrics([]).columns
+  region_metrics = {}
+  for region, region_results in (("cb", results[:len(subjects)]), ("ctx", results[len(subjects):])):
+    region_results = [r for r in region_results if r is not None]
+    metrics = pd.DataFrame(
+      [[r[c] for c in columns] for r in region_results], columns=columns)
+    metrics.index = [r["Name"] for r in region_results]
+    region_metrics[region] = metrics
+  save_area_length(list(region_metrics["cb"].index), region_metrics["cb"],
+    derived_path("csv", "01_cb_area_length.csv"))
+  save_area_length(list(region_metrics["ctx"].index), region_metrics["ctx"],
+    derived_path("csv", "02_ctx_area_length.csv"))
+
+  if metrics_path is not None:
+    metrics = pd.concat([region_metrics["cb"], region_metrics["ctx"]])
+    metrics.insert(
+      0, "Region", ["cb"]*len(region_metrics["cb"]) + ["ctx"]*len(region_metrics["ctx"]))
+    atomic_write_csv(metrics, metrics_path)
+
+def main(argv=None):
+  '''Command line interface'''
+  parser = add_workers_argument(argparse.ArgumentParser())
+  add_annotations_argument(parser)
+  parser.add_argument(
+    "--metrics", default=None,
+    help="also save all geometric measurements (bounds, convex hull, "
+    "folding index) of cb and ctx sections to this csv file")
+  add_incremental_argument(parser)
+  add_report_arguments(parser)
+  args = parser.parse_args(argv)
+  run_report = start_run(args, "1_section_area_length")
+  if args.incremental:
+    compute_area_length_incremental(
+      args.workers, args.annotations, args.metrics, run_report)
+  else:
+    compute_area_length_for_all(
+      args.workers, args.annotations, args.metrics, run_report)
+  if run_report is not None:
+    run_report.close()
+
+if __name__ == "__main__":
+  main()
@@ -5,57 +5,185 @@
 
 '''Compute and save gyral measurements for all subjects in the dataset'''
 
-import json
+import argparse
+import logging
 import numpy as np
 import pandas as pd
+import shapely
 import gyri as gy
-from convert_polygons_to_shapely_multipolygons import convert_polygons_to_shapely_multipolygons
+from contour_artifacts import ContourArtifacts
+from dataset import load_dataset, derived_path
+from annotation_store import load_contour, annotation_path, add_annotations_argument
+from image_cache import add_cache_arguments, open_cache
+from incremental_build import (Manifest, manifest_path, code_version, input_hash,
+  run_incremental, atomic_write_csv, add_incremental_argument)
+from run_report import stage, start_run, add_report_arguments
+from specimen_executor import map_specimens, add_workers_argument, add_prefetch_arguments
 
-data = pd.read_csv("../data/raw/01_cb_data.csv")
-scale = np.array(pd.read_csv("../data/raw/02_scale.csv")["Scale"])
+log = logging.getLogger("2_figure3_folial_width_perimeter")
 
-def compute_gyral_measurements_for_all():
-  '''compute gyral measurements for all subjects in the dataset'''
+# source files whose changes invalidate the results of the stage
+STAGE_FILES = [
+  "2_figure3_folial_width_perimeter.py", "gyri.py", "contour_resampling.py",
+  "contour_artifacts.py",
+  "annotation_store.py", "convert_polygons_to_shapely_multipolygons.py"]
 
-  results_period = []
-  results_width = []
-  for row in range(len(data)):
-    # get scale. Skip subject if scale is unavailable
-    if scale[row] == 0:
-      continue
+def measure_folds(cb_mid, artifacts=None, iters=10, n_clusters=3, n_points=None):
+  '''Resample and label a cerebellum contour, and segment it into folds
+  Parameters
+  ----------
+  cb_mid : shapely.geometry.MultiPolygon
+    cerebellum contour
+  artifacts : contour_artifacts.ContourArtifacts
+    if provided, intermediate results on the contour, possibly cached
+  iters, n_clusters : int
+    parameters of gyri.label_contour
+  n_points : int
+    number of vertices the contour is resampled to, by default scaled
+    with its length (gyri.resample_cerebellum_contour)
+  Returns
+  -------
+  period : np.array
+    gyral period of each fold
+  width : np.array
+    gyral width of each fold
+  As in compute_gyral_period and compute_gyral_width, both arrays end
+  with a 0 marking the end of the contour
+  '''
+  if artifacts is None:
+    artifacts = ContourArtifacts(cb_mid)
+  with stage("resample") as info:
+    polys, min_length = artifacts.gyri_contour(n_points)
+    info["vertices"] = len(polys)
+  with stage("label_contour", vertices=len(polys)):
+    labels, sulci_index, _, _ = artifacts.gyri_labels(n_points, iters, n_clusters)
+  with stage("segment_folds", vertices=len(polys)) as info:
+    labels = gy.filter_sulci(labels, sulci_index)
+    folds = gy.segment_folds(labels, 1, polys, min_length)
+    info["folds"] = len(folds)
+  return np.append(folds["period"], 0), np.append(folds["width"], 0)
 
-    source = data.iloc[row]["URL"]
-    dic = json.load(
-      open(f"../data/raw/json/cb/{source.split('/')[-1]}.cb-50%.json",
-      "r", encoding="utf-8"))
-    cb_polys = dic["slice_polygons"]
-    name = dic["name"]
-    cb_mid = convert_polygons_to_shapely_multipolygons(cb_polys)
+def load_subject(row, source, annotations=None, cache=None): # pylint: disable=unused-argument
+  '''Read the name and contour of a subject. Takes the same arguments as
+  compute_gyral_measurements'''
+  with stage("load_json") as info:
+    name, cb_mid = load_contour(source, "cb", annotations)
+    info["vertices"] = int(shapely.get_num_coordinates(cb_mid))
+  return name, cb_mid
 
-    polys, min_length = gy.resample_cerebellum_contour(cb_mid)
-    labels, sulci_index, _, _ = gy.label_contour(polys)
-    labels = gy.filter_sulci(labels, sulci_index)
+def compute_gyral_measurements(row, source, annotations=None, cache=None, loaded=None):
+  '''compute gyral measurements for one subject
+  Parameters
+  ----------
+  row : int
+    row of the subject in the dataset
+  source : str
+    URL of the subject in MicroDraw
+  annotations : str
+    path of an annotation store. If None, the JSON annotation is read
+  cache : image_cache.ImageCache
+    if provided, cache of the contour artifacts
+  loaded : tuple
+    name and contour of the subject read by load_subject. Read if not
+    provided
+  Returns
+  -------
+  period : tuple
+    name, median, mean and std of the gyral period
+  width : tuple
+    name, median, mean and std of the gyral width
+  '''
+  if loaded is None:
+    loaded = load_subject(row, source, annotations)
+  name, cb_mid = loaded
 
-    period = gy.compute_gyral_period(labels, 1, min_length)
-    width = gy.compute_gyral_width(labels, 1, polys)
+  period, width = measure_folds(cb_mid, ContourArtifacts(cb_mid, name, cache))
 
-    results_period.append((name, np.median(period), np.mean(period), np.std(period)))
-    results_width.append((name, np.median(width), np.mean(width), np.std(width)))
+  log.info("%s %s %s %s", row, name, np.median(period), np.median(width))
 
-    print(row, name, np.median(period), np.median(width))
+  return (
+    (name, np.median(period), np.mean(period), np.std(period)),
+    (name, np.median(width), np.mean(width), np.std(width))
+  )
+
+def gyral_tasks(annotations=None, cache=None):
+  '''Arguments of compute_gyral_measurements for each subject with a scale'''
+  data, scale = load_dataset()
+  tasks = []
+  for row in range(len(data)):
+    # get scale. Skip subject if scale is unavailable
+    if scale[row] == 0:
+      continue
+    tasks.append((row, data.iloc[row]["URL"], annotations, cache))
+  return tasks
+
+def save_gyral_measurements(results):
+  '''Save the widths and periods returned by compute_gyral_measurements
+  for each subject, skipping None'''
+  results = [r for r in results if r is not None]
+  results_period = [r[0] for r in results]
+  results_width = [r[1] for r in results]
 
-  # save results
   data_frame = pd.DataFrame(
     [col[1:] for col in results_width],
     index=[col[0] for col in results_width],
     columns = ["WidthMedian", "WidthMean", "WidthStd"])
-  data_frame.to_csv("../data/derived/csv/03_cb_width.csv")
+  atomic_write_csv(data_frame, derived_path("csv", "03_cb_width.csv"))
 
   data_frame = pd.DataFrame(
     [col[1:] for col in results_period],
     index=[col[0] for col in results_period],
     columns = ["PeriodMedian", "PeriodMean", "PeriodStd"])
-  data_frame.to_csv("../data/derived/csv/04_cb_period.csv")
+  atomic_write_csv(data_frame, derived_path("csv", "04_cb_period.csv"))
+
+def compute_gyral_measurements_for_all(
+  n_workers=1, annotations=None, incremental=False, report=None, prefetch=2,
+  cache=None
+):
+  '''compute gyral measurements for all subjects in the dataset. If
+  incremental is True, only the subjects whose annotation, data or scale
+  changed since the last run are computed. If a run_report.RunReport is
+  provided, the stages of each subject are profiled. When running
+  serially, the contours of the next prefetch subjects are read in
+  background threads. If an image_cache.ImageCache is provided, the
+  resampled contours, features and labels are read from or saved to it'''
+
+  data, scale = load_dataset()
+  tasks = gyral_tasks(annotations, cache)
+
+  options = {"report": report, "load": load_subject, "prefetch": prefetch}
+  if incremental:
+    version = code_version(STAGE_FILES)
+    keys = [task[1].split("/")[-1] for task in tasks]
+    digests = [
+      input_hash(
+        files=[annotation_path(source, "cb")],
+        values=[version, data.iloc[row].to_json(), scale[row]])
+      for row, source, *_ in tasks]
+    results = run_incremental(
+      compute_gyral_measurements, tasks, keys, digests,
+      Manifest(manifest_path("03_gyral_measurements")), n_workers, **options)
+  else:
+    results, _ = map_specimens(
+      compute_gyral_measurements, tasks, n_workers,
+      labels=[task[0] for task in tasks], **options)
+  save_gyral_measurements(results)
 
+def main(argv=None):
+  '''Command line interface'''
+  parser = add_workers_argument(argparse.ArgumentParser(description=__doc__))
+  add_annotations_argument(parser)
+  add_incremental_argument(parser)
+  add_report_arguments(parser)
+  add_prefetch_arguments(parser)
+  add_cache_arguments(parser)
+  args = parser.parse_args(argv)
+  run_report = start_run(args, "2_figure3_folial_width_perimeter")
+  compute_gyral_measurements_for_all(
+    args.workers, args.annotations, args.incremental, run_report, args.prefetch,
+    open_cache(args))
+  if run_report is not None:
+    run_report.close()
 
-compute_gyral_measurements_for_all()
+if __name__ == "__main__":
+  main()
@@ -3,43 +3,255 @@
 # 1 February 2023
 #----------------------------------------
 
-import json
-import numpy as np
-import pandas as pd
+import argparse
+import logging
+import os
+import shapely
 import thickness as th
-from convert_polygons_to_shapely_multipolygons import convert_polygons_to_shapely_multipolygons
+from dataset import load_dataset, raw_path, derived_path
+from annotation_store import load_contour, annotation_path, add_annotations_argument
+from image_cache import add_cache_arguments, open_cache
+from result_journal import ResultJournal
+from incremental_build import (Manifest, manifest_path, code_version, input_hash,
+  run_incremental, atomic_write, add_incremental_argument)
+from run_report import stage, start_run, add_report_arguments
+from specimen_executor import map_specimens, add_workers_argument, add_prefetch_arguments
 
-data = pd.read_csv("../data/raw/01_cb_data.csv")
-scale = np.array(pd.read_csv("../data/raw/02_scale.csv")["Scale"])
+log = logging.getLogger("3_figure4_thickness")
 
-def compute_all_thicknesses():
-  '''compute thickness of the molecular layer for all subjects'''
+# source files whose changes invalidate the results of the stage
+STAGE_FILES = [
+  "3_figure4_thickness.py", "thickness.py", "contour_resampling.py",
+  "contour_artifacts.py", "gyri.py",
+  "rasterize_polygons.py", "annotation_store.py",
+  "convert_polygons_to_shapely_multipolygons.py"]
 
-  # loop to process all subjects
-  with open("../data/derived/csv/05_cb_thickness.csv", "w", encoding="utf-8") as file:
+def image_path(source):
+  '''Path of the cerebellum image of a subject'''
+  return raw_path("img", "cb", source.split("/")[-1] + ".cb-50%.png")
+
+def journal_path():
+  '''Path of the journal of the thickness results'''
+  return derived_path("journal", "05_cb_thickness.jsonl")
+
+def load_subject(
+  row, source, scale_row, roi_margin=None, cache=None, cache_gradients=False,
+  profiles_dir=None, annotations=None
+): # pylint: disable=unused-argument
+  '''Read the contour and the image of a subject. Takes the same arguments
+  as compute_subject_thickness
+  Returns
+  -------
+  dict
+    name, contour (cb_mid) and image (img) of the subject. The image is
+    None if it is missing or if preprocessed images are cached, in which
+    case it is read only if needed
+  '''
+  with stage("load_json") as info:
+    name, cb_mid = load_contour(source, "cb", annotations)
+    info["vertices"] = int(shapely.get_num_coordinates(cb_mid))
+  img = None
+  img_path = image_path(source)
+  if cache is None and os.path.exists(img_path):
+    with stage("read_image") as info:
+      img = th.read_image(img_path)
+      info["pixels"] = img.shape[0]*img.shape[1]
+  return {"name": name, "cb_mid": cb_mid, "img": img}
+
+def compute_subject_thickness(
+  row, source, scale_row, roi_margin=None, cache=None, cache_gradients=False,
+  profiles_dir=None, annotations=None, loaded=None
+):
+  '''compute thickness of the molecular layer for one subject
+  Parameters
+  ----------
+  row : int
+    row of the subject in the dataset
+  source : str
+    URL of the subject in MicroDraw
+  scale_row : float
+    scale of the subject
+  roi_margin : int
+    if provided, crop the image to the contour plus this margin (px)
+  cache : image_cache.ImageCache
+    if provided, cache of preprocessed images
+  cache_gradients : bool
+    also cache the smoothed images and gradients
+  profiles_dir : str
+    if provided, directory where per-profile thicknesses are saved
+  annotations : str
+    path of an annotation store. If None, the JSON annotation is read
+  loaded : dict
+    data of the subject read by load_subject. Read if not provided
+  Returns
+  -------
+  str or None
+    csv line with the thickness statistics
+  '''
+  if loaded is None:
+    loaded = load_subject(
+      row, source, scale_row, roi_margin, cache, cache_gradients, profiles_dir,
+      annotations)
+  name, cb_mid = loaded["name"], loaded["cb_mid"]
+
+  img_path = image_path(source)
+  profiles_path = None
+  if profiles_dir is not None:
+    profiles_path = os.path.join(profiles_dir, source.split("/")[-1] + ".profiles.npz")
+
+  log.info("%s %s %s", row, name, source)
+  return th.compute_thickness(
+      scale_row, cb_mid, name,
+      img_path, roi_margin=roi_margin,
+      cache=cache, cache_gradients=cache_gradients,
+      profiles_path=profiles_path, img=loaded["img"]
+  )
+
+def run_journaled(tasks, keys, params, n_workers=1, resume=False, **options):
+  '''Compute the thickness of subjects, recording each result in the
+  journal as soon as it is available
+  Parameters
+  ----------
+  tasks : list of tuple
+    arguments of compute_subject_thickness for each subject
+  keys : list of str
+    key of each subject in the journal
+  params : dict
+    parameters of the run. A journal is only resumed with the same parameters
+  n_workers : int
+    number of worker processes
+  resume : bool
+    skip the subjects recorded in the journal by a previous run
+  options : dict
+    other options of map_specimens (report, prefetch...)
+  Returns
+  -------
+  results : list
+    result of each subject, None where it failed
+  errors : list of tuple
+    (row, error message) for each failed subject
+  '''
+  journal = ResultJournal(journal_path())
+  done = journal.load(params) if resume else {}
+  journal.start(params, done)
+  todo = [i for i, key in enumerate(keys) if key not in done]
+  log.info("%d subjects already done, %d to compute", len(tasks) - len(todo), len(todo))
+  results, errors = map_specimens(
+    compute_subject_thickness, [tasks[i] for i in todo], n_workers,
+    labels=[tasks[i][0] for i in todo],
+    on_result=lambda index, result: journal.append(keys[todo[index]], result),
+    **options)
+  done.update((keys[i], result) for i, result in zip(todo, results))
+  return [done.get(key) for key in keys], errors
+
+def thickness_tasks(
+  roi_margin=None, cache=None, cache_gradients=False, profiles_dir=None,
+  annotations=None
+):
+  '''Arguments of compute_subject_thickness for each subject with a
+  scale. Creates profiles_dir if needed'''
+  if profiles_dir is not None:
+    os.makedirs(profiles_dir, exist_ok=True)
+
+  data, scale = load_dataset()
+  tasks = []
+  for row in range(len(data)):
+    name = data.iloc[row]["Name"]
+    source = data.iloc[row]["URL"]
+
+    if scale[row] == 0:
+      log.info("%s %s %s no scale", row, name, source)
+      continue
+    tasks.append((
+      row, source, scale[row], roi_margin, cache, cache_gradients, profiles_dir,
+      annotations))
+  return tasks
+
+def save_thicknesses(results):
+  '''Save the csv lines returned by compute_subject_thickness for each
+  subject, skipping None'''
+  def write(file):
     file.write(",ThicknessMedian,ThicknessMean,ThicknessStd\n")
-    for row in range(len(data)):
-      name = data.iloc[row]["Name"]
-      source = data.iloc[row]["URL"]
-      print(row, name, source)
-
-      if scale[row] == 0:
-        continue
-
-      dic = json.load(
-        open(f"../data/raw/json/cb/{source.split('/')[-1]}.cb-50%.json",
-        "r", encoding="utf-8"))
-      cb_polys = dic["slice_polygons"]
-      name = dic["name"]
-      cb_mid = convert_polygons_to_shapely_multipolygons(cb_polys)
-
-      img_path = "../data/raw/img/cb/" + source.split("/")[-1] + ".cb-50%.png"
-
-      result_data = th.compute_thickness(
-          scale[row], cb_mid, name,
-          img_path
-      )
+    for result_data in results:
       if result_data:
         file.write(result_data)
+  atomic_write(derived_path("csv", "05_cb_thickness.csv"), write)
+
+def compute_all_thicknesses(
+  n_workers=1, roi_margin=None, cache=None, cache_gradients=False,
+  profiles_dir=None, annotations=None, incremental=False, resume=False,
+  report=None, prefetch=2, prefetch_bytes=None
+):
+  '''compute thickness of the molecular layer for all subjects. If
+  incremental is True, only the subjects whose annotation, image, data or
+  scale changed since the last run are computed. Otherwise, the result of
+  each subject is recorded in a journal as soon as it is computed, and if
+  resume is True the subjects recorded by an interrupted run are skipped.
+  If a run_report.RunReport is provided, the stages of each subject are
+  profiled. When running serially, the contours and images of the next
+  prefetch subjects are read in background threads, up to prefetch_bytes
+  of images'''
+
+  data, _ = load_dataset()
+  tasks = thickness_tasks(
+    roi_margin, cache, cache_gradients, profiles_dir, annotations)
+
+  # process all subjects
+  options = {
+    "report": report, "load": load_subject, "prefetch": prefetch,
+    "prefetch_bytes": prefetch_bytes}
+  errors = []
+  keys = [task[1].split("/")[-1] for task in tasks]
+  if incremental:
+    version = code_version(STAGE_FILES)
+    # the cache options do not change the results
+    digests = [
+      input_hash(
+        files=[annotation_path(task[1], "cb"), image_path(task[1])],
+        values=[version, data.iloc[task[0]].to_json(), task[2], roi_margin, profiles_dir])
+      for task in tasks]
+    results = run_incremental(
+      compute_subject_thickness, tasks, keys, digests,
+      Manifest(manifest_path("05_thickness")), n_workers, **options)
+  else:
+    results, errors = run_journaled(
+      tasks, keys, {"roi_margin": roi_margin, "profiles_dir": profiles_dir},
+      n_workers, resume, **options)
+
+  save_thicknesses(results)
+  # keep the journal if some subjects failed, to retry only them with --resume
+  if not incremental and not errors:
+    ResultJournal(journal_path()).remove()
+
+def main(argv=None):
+  '''Command line interface'''
+  parser = add_workers_argument(argparse.ArgumentParser())
+  parser.add_argument(
+    "--roi-margin", type=int, default=None,
+    help="crop images to the cerebellum contour plus this margin (px)")
+  add_cache_arguments(parser)
+  parser.add_argument(
+    "--cache-gradients", action="store_true",
+    help="also cache smoothed images and gradients")
+  parser.add_argument(
+    "--profiles-dir", default=None,
+    help="directory where per-profile thicknesses are saved (.npz)")
+  add_annotations_argument(parser)
+  add_incremental_argument(parser)
+  parser.add_argument(
+    "--resume", action="store_true",
+    help="skip the subjects already computed by an interrupted run, "
+    "as recorded in the journal of data/derived/journal")
+  add_report_arguments(parser)
+  add_prefetch_arguments(parser)
+  args = parser.parse_args(argv)
+  run_report = start_run(args, "3_figure4_thickness")
+  compute_all_thicknesses(
+    args.workers, args.roi_margin, open_cache(args), args.cache_gradients,
+    args.profiles_dir, args.annotations, args.incremental, args.resume,
+    run_report, args.prefetch, int(args.prefetch_memory*2**30))
+  if run_report is not None:
+    run_report.close()
 
-compute_all_thicknesses()
+if __name__ == "__main__":
+  main()
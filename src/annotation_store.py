@@ -0,0 +1,230 @@
+'''Columnar binary store of the cerebellum and cerebrum annotations
+
+The polygons of all specimens are packed once into flat arrays, in the
+layout used by Arrow and shapely.to_ragged_array for multipolygons:
+  coords : float64 (n_coords, 2), vertices of all rings
+  ring_offsets : int64, start of each ring in coords
+  polygon_offsets : int64, start of each polygon in the rings
+  specimen_offsets : int64, start of each specimen in the polygons
+The arrays are stored in a single file after a JSON header, and are opened
+memory-mapped. Shapely geometries are built in bulk from the arrays only
+when needed.
+
+Usage: python annotation_store.py [--output data/derived/annotations.bin]
+'''
+
+import argparse
+import json
+import os
+import numpy as np
+import shapely
+from convert_polygons_to_shapely_multipolygons import convert_polygons_to_shapely_multipolygons
+from dataset import load_dataset, raw_path, derived_path
+
+MAGIC = b"CBANNOT1"
+ALIGN = 64
+ARRAYS = ["coords", "ring_offsets", "polygon_offsets", "specimen_offsets"]
+
+def annotation_path(source, region, json_dir=None):
+  '''Path of the JSON annotation of a specimen for a region (cb or ctx).
+  json_dir defaults to the json directory of the raw data'''
+  if json_dir is None:
+    json_dir = raw_path("json")
+  return f"{json_dir}/{region}/{source.split('/')[-1]}.{region}-50%.json"
+
+def read_annotation(path):
+  '''Read a MicroDraw JSON annotation
+  Returns
+  -------
+  name : str
+    name of the specimen
+  polygons : list of list of np.array
+    rings of each polygon, the first ring is the exterior, the rest are holes
+  '''
+  with open(path, "r", encoding="utf-8") as file:
+    dic = json.load(file)
+  polygons = [
+    [np.asarray(ring, dtype=float).reshape(-1, 2) for ring in p[0]]
+    for p in dic["slice_polygons"]
+  ]
+  return dic["name"], polygons
+
+def compile_annotations(sources, path, regions=("cb", "ctx"), json_dir=None):
+  '''Pack the annotations of all specimens into a single store file
+  Parameters
+  ----------
+  sources : list of str
+    MicroDraw URLs of the specimens
+  path : str
+    path of the store file
+  regions : tuple of str
+    regions to include
+  json_dir : str
+    directory containing one subdirectory of JSON annotations per region.
+    Defaults to the json directory of the raw data
+  '''
+  specimens = []
+  coords = []
+  ring_offsets = [0]
+  polygon_offsets = [0]
+  specimen_offsets = [0]
+  for region in regions:
+    for source in sources:
+      json_path = annotation_path(source, region, json_dir)
+      if not os.path.exists(json_path):
+        continue
+      name, polygons = read_annotation(json_path)
+      for rings in polygons:
+        for ring in rings:
+          # close rings, as shapely does
+          if not np.array_equal(ring[0], ring[-1]):
+            ring = np.concatenate([ring, ring[:1]])
+          coords.append(ring)
+          ring_offsets.append(ring_offsets[-1] + len(ring))
+        polygon_offsets.append(polygon_offsets[-1] + len(rings))
+      specimen_offsets.append(specimen_offsets[-1] + len(polygons))
+      specimens.append({
+        "region": region, "source": source.split("/")[-1], "name": name})
+
+  arrays = {
+    "coords": np.concatenate(coords) if coords else np.zeros((0, 2)),
+    "ring_offsets": np.array(ring_offsets, dtype=np.int64),
+    "polygon_offsets": np.array(polygon_offsets, dtype=np.int64),
+    "specimen_offsets": np.array(specimen_offsets, dtype=np.int64)
+  }
+  write_store(path, specimens, arrays)
+
+def write_store(path, specimens, arrays):
+  '''Write the header and arrays of a store, atomically'''
+  layout = {}
+  offset = 0
+  for key in ARRAYS:
+    offset = -(-offset//ALIGN)*ALIGN
+    layout[key] = {
+      "dtype": arrays[key].dtype.str, "shape": arrays[key].shape, "offset": offset}
+    offset += arrays[key].nbytes
+  header = json.dumps({"specimens": specimens, "arrays": layout}).encode("utf-8")
+  data_start = -(-(len(MAGIC) + 8 + len(header))//ALIGN)*ALIGN
+
+  tmp = path + ".tmp"
+  with open(tmp, "wb") as file:
+    file.write(MAGIC)
+    file.write(np.int64(len(header)).tobytes())
+    file.write(header)
+    for key in ARRAYS:
+      file.seek(data_start + layout[key]["offset"])
+      file.write(np.ascontiguousarray(arrays[key]).tobytes())
+  os.replace(tmp, path)
+
+class AnnotationStore:
+  '''Memory-mapped annotation store
+  Parameters
+  ----------
+  path : str
+    path of a file written by compile_annotations
+  '''
+
+  def __init__(self, path):
+    with open(path, "rb") as file:
+      if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{path} is not an annotation store")
+      header_length = int(np.frombuffer(file.read(8), dtype=np.int64)[0])
+      header = json.loads(file.read(header_length).decode("utf-8"))
+    data_start = -(-(len(MAGIC) + 8 + header_length)//ALIGN)*ALIGN
+
+    self.specimens = header["specimens"]
+    self._index = {
+      (s["region"], s["source"]): i for i, s in enumerate(self.specimens)}
+    for key, spec in header["arrays"].items():
+      shape = tuple(spec["shape"])
+      if np.prod(shape) == 0:
+        array = np.zeros(shape, dtype=spec["dtype"])
+      else:
+        array = np.memmap(
+          path, dtype=spec["dtype"], mode="r",
+          offset=data_start + spec["offset"], shape=shape)
+      setattr(self, key, array)
+
+  def find(self, region, source):
+    '''Index of a specimen from its region and MicroDraw URL'''
+    return self._index[(region, source.split("/")[-1])]
+
+  def name(self, index):
+    '''Name of a specimen'''
+    return self.specimens[index]["name"]
+
+  def ragged(self, indices):
+    '''Coordinates and offsets of a contiguous range of specimens
+    Parameters
+    ----------
+    indices : slice
+      range of specimens
+    Returns
+    -------
+    coords : np.array
+      vertices (a view of the memory-mapped array)
+    offsets : tuple of np.array
+      ring, polygon and specimen offsets, relative to the range
+    '''
+    start, stop, _ = indices.indices(len(self.specimens))
+    spec = self.specimen_offsets[start:stop + 1]
+    poly = self.polygon_offsets[spec[0]:spec[-1] + 1]
+    ring = self.ring_offsets[poly[0]:poly[-1] + 1]
+    coords = self.coords[ring[0]:ring[-1]]
+    return coords, (ring - ring[0], poly - poly[0], spec - spec[0])
+
+  def geometries(self, indices=slice(None)):
+    '''Shapely multipolygons of a range of specimens, built in bulk'''
+    coords, offsets = self.ragged(indices)
+    return shapely.from_ragged_array(
+      shapely.GeometryType.MULTIPOLYGON, np.asarray(coords), offsets)
+
+  def geometry(self, index):
+    '''Shapely multipolygon of a specimen'''
+    return self.geometries(slice(index, index + 1))[0]
+
+  def region_range(self, region):
+    '''Range of the specimens of a region'''
+    indices = [i for i, s in enumerate(self.specimens) if s["region"] == region]
+    if not indices:
+      return slice(0, 0)
+    return slice(indices[0], indices[-1] + 1)
+
+_open_stores = {}
+
+def open_store(path):
+  '''Open a store once per process'''
+  if path not in _open_stores:
+    _open_stores[path] = AnnotationStore(path)
+  return _open_stores[path]
+
+def load_contour(source, region, store_path=None):
+  '''Name and multipolygon of a specimen, read from the store if
+  store_path is provided, otherwise from its JSON annotation'''
+  if store_path is None:
+    with open(annotation_path(source, region), "r", encoding="utf-8") as file:
+      dic = json.load(file)
+    return dic["name"], convert_polygons_to_shapely_multipolygons(dic["slice_polygons"])
+  store = open_store(store_path)
+  index = store.find(region, source)
+  return store.name(index), store.geometry(index)
+
+def add_annotations_argument(parser):
+  '''Add the --annotations option to an argparse parser'''
+  parser.add_argument(
+    "--annotations", default=None,
+    help="annotation store compiled by annotation_store.py "
+    "(default: read the JSON annotations)")
+  return parser
+
+def main(argv=None):
+  '''Command line interface'''
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--output", default=derived_path("annotations.bin"))
+  args = parser.parse_args(argv)
+  data, _ = load_dataset()
+  compile_annotations(list(data["URL"]), args.output)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,292 @@
+'''Benchmarks of the gyri and thickness functions on the bundled specimens
+
+Micro-benchmarks time the main functions of gyri.py and thickness.py on
+the data of one specimen of median size; end-to-end benchmarks time the
+gyral measurements and the thickness of the smallest, median and largest
+cerebellum images of data/raw. Results are saved as JSON, and can be
+compared to a baseline to detect regressions.
+
+Usage:
+  python benchmarks.py run [--output FILE] [--repeat N] [--quick]
+  python benchmarks.py compare BASELINE [CURRENT] [--threshold 0.2]
+With one file, compare runs the benchmarks and compares them to the
+baseline. compare exits with status 1 if some benchmark is slower than
+the baseline by more than the threshold.
+'''
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import struct
+import sys
+import timeit
+import numpy as np
+import scipy
+import shapely
+import gyri as gy
+import thickness as th
+from annotation_store import load_contour, annotation_path
+from dataset import load_dataset, derived_path
+from run_report import configure_logging
+
+DEFAULT_BASELINE = derived_path("benchmarks", "baseline.json")
+
+def png_size(path):
+  '''Width and height of a png image, read from its header'''
+  with open(path, "rb") as file:
+    header = file.read(24)
+  return struct.unpack(">II", header[16:24])
+
+def select_specimens():
+  '''Rows of the specimens with the smallest, median and largest
+  cerebellum images, among those with a scale, an annotation and an image
+  Returns
+  -------
+  dict
+    row of the specimen for "small", "median" and "large"
+  '''
+  thicknesses = importlib.import_module("3_figure4_thickness")
+  data, scale = load_dataset()
+  candidates = []
+  for row in range(len(data)):
+    source = data.iloc[row]["URL"]
+    img_path = thicknesses.image_path(source)
+    if (
+      scale[row] == 0
+      or not os.path.exists(img_path)
+      or not os.path.exists(annotation_path(source, "cb"))
+    ):
+      continue
+    width, height = png_size(img_path)
+    candidates.append((width*height, row))
+  candidates.sort()
+  return {
+    "small": candidates[0][1],
+    "median": candidates[len(candidates)//2][1],
+    "large": candidates[-1][1]
+  }
+
+def time_function(func, repeat):
+  '''Time repeated calls to func
+  Returns
+  -------
+  dict
+    minimum, median and mean time (s) of the calls
+  '''
+  times = timeit.Timer(func).repeat(repeat=repeat, number=1)
+  return {"min": min(times), "median": float(np.median(times)), "mean": float(np.mean(times))}
+
+def micro_benchmarks(row):
+  '''Functions to benchmark on the data of a specimen
+  Returns
+  -------
+  dict
+    function without arguments for each benchmark name
+  '''
+  thicknesses = importlib.import_module("3_figure4_thickness")
+  data, scale = load_dataset()
+  source = data.iloc[row]["URL"]
+  scale_row = scale[row]
+  _, cb_mid = load_contour(source, "cb")
+
+  # gyri
+  polys, _ = gy.resample_cerebellum_contour(cb_mid)
+
+  # thickness, following compute_thickness
+  img = th.load_image(thicknesses.image_path(source))
+  img_width = img.shape[1]
+  scaled_mpoly = th.scale_contour_to_image(img_width, scale_row, cb_mid)
+  min_length = th.cr.thickness_min_length(scaled_mpoly.length*1000/img_width)
+  geoms = list(getattr(scaled_mpoly, "geoms", [scaled_mpoly]))
+  largest = max(geoms, key=lambda g: g.exterior.length)
+  pp = th.resample_contour(largest, img_width, min_length)
+  mask = th.make_mask(img, geoms)
+  DxW, DyW, smo = th.compute_image_gradients(img, mask)
+  fni, fng, fnx, fny = th.interp_functions(img, smo, DxW, DyW)
+  profile_lines, _ = th.get_profile_lines(pp, fng, fnx, fny)
+  profile_levels = th.get_profile_levels(profile_lines, fni, 40)
+
+  return {
+    "gyri.smooth_polygon": lambda: gy.smooth_polygon(polys, 10),
+    "gyri.curvature_features": lambda: gy.curvature_features(polys),
+    "gyri.label_contour": lambda: gy.label_contour(polys),
+    "gyri.resample_cerebellum_contour": lambda: gy.resample_cerebellum_contour(cb_mid),
+    "contour_resampling.polygon_normals": lambda: th.cr.polygon_normals(pp),
+    "thickness.make_mask": lambda: th.make_mask(img, geoms),
+    "thickness.compute_image_gradients": lambda: th.compute_image_gradients(img, mask),
+    "thickness.get_profile_lines": lambda: th.get_profile_lines(pp, fng, fnx, fny),
+    "thickness.molecular_layer_thickness": lambda: th.molecular_layer_thickness(profile_levels)
+  }
+
+def end_to_end_benchmarks(rows):
+  '''Per-specimen benchmarks of the gyral measurements and the thickness
+  Parameters
+  ----------
+  rows : dict
+    row of the specimen for each size
+  Returns
+  -------
+  dict
+    function without arguments for each benchmark name
+  '''
+  gyral = importlib.import_module("2_figure3_folial_width_perimeter")
+  thicknesses = importlib.import_module("3_figure4_thickness")
+  data, scale = load_dataset()
+  benchmarks = {}
+  for size, row in rows.items():
+    source = data.iloc[row]["URL"]
+    benchmarks[f"gyral_measurements.{size}"] = (
+      lambda row=row, source=source: gyral.compute_gyral_measurements(row, source))
+    benchmarks[f"thickness.{size}"] = (
+      lambda row=row, source=source: thicknesses.compute_subject_thickness(
+        row, source, scale[row]))
+  return benchmarks
+
+def environment():
+  '''Description of the machine and library versions'''
+  # imported here to keep the import of the module fast
+  import skimage # pylint: disable=import-outside-toplevel
+  import sklearn # pylint: disable=import-outside-toplevel
+  return {
+    "date": datetime.datetime.now().isoformat(timespec="seconds"),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "processor": platform.processor(),
+    "cpu_count": os.cpu_count(),
+    "numpy": np.__version__,
+    "scipy": scipy.__version__,
+    "shapely": shapely.__version__,
+    "scikit-image": skimage.__version__,
+    "scikit-learn": sklearn.__version__
+  }
+
+def run_benchmarks(repeat=5, quick=False):
+  '''Run all benchmarks
+  Parameters
+  ----------
+  repeat : int
+    number of timed calls of each micro-benchmark. End-to-end benchmarks
+    are called max(1, repeat//2) times
+  quick : bool
+    only run the end-to-end benchmarks of the smallest specimen. The
+    micro-benchmarks are run on the specimen of median size as usual
+  Returns
+  -------
+  dict
+    environment, specimens and timings of each benchmark, with the row of
+    the specimen it was run on
+  '''
+  rows = select_specimens()
+  end_to_end_rows = {"small": rows["small"]} if quick else rows
+  benchmarks = [(rows["median"], micro_benchmarks(rows["median"]), repeat)]
+  for size, row in end_to_end_rows.items():
+    benchmarks.append((row, end_to_end_benchmarks({size: row}), max(1, repeat//2)))
+  results = {}
+  for row, funcs, n in benchmarks:
+    for name, func in funcs.items():
+      results[name] = {**time_function(func, n), "specimen": int(row)}
+      print(f"{name:<45} {results[name]['min']*1000:10.2f} ms", flush=True)
+  specimens = {"micro": int(rows["median"]), **{k: int(v) for k, v in end_to_end_rows.items()}}
+  return {"environment": environment(), "specimens": specimens, "results": results}
+
+def save_results(results, path):
+  '''Save benchmark results as JSON'''
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path, "w", encoding="utf-8") as file:
+    json.dump(results, file, indent=1)
+
+def compare_results(baseline, current, threshold=0.2):
+  '''Compare the minimum times of two benchmark runs
+  Parameters
+  ----------
+  baseline, current : dict
+    results of run_benchmarks
+  threshold : float
+    relative slowdown above which a benchmark is a regression
+  Returns
+  -------
+  lines : list of str
+    comparison table
+  regressions : list of str
+    names of the benchmarks slower than the baseline by more than threshold
+  '''
+  lines = [f"{'benchmark':<45} {'baseline':>10} {'current':>10} {'ratio':>7}"]
+  regressions = []
+  different = []
+  for name in sorted(set(baseline["results"]) | set(current["results"])):
+    if name not in baseline["results"] or name not in current["results"]:
+      only = "current" if name in current["results"] else "baseline"
+      lines.append(f"{name:<45} {'only in ' + only:>29}")
+      continue
+    before = baseline["results"][name]
+    after = current["results"][name]
+    ratio = after["min"]/before["min"]
+    flag = ""
+    rows = [before.get("specimen"), after.get("specimen")]
+    if None not in rows and rows[0] != rows[1]:
+      # not comparable: not counted as a regression
+      flag = "  different specimen"
+      different.append(name)
+    elif ratio > 1 + threshold:
+      flag = "  REGRESSION"
+      regressions.append(name)
+    elif ratio < 1/(1 + threshold):
+      flag = "  faster"
+    lines.append(
+      f"{name:<45} {before['min']*1000:8.2f}ms {after['min']*1000:8.2f}ms {ratio:7.2f}{flag}")
+  if different:
+    lines.append(f"WARNING: {len(different)} benchmark(s) were run on different specimens")
+  elif "specimen" not in next(iter(baseline["results"].values()), {}):
+    # results saved without the specimen of each benchmark
+    if baseline.get("specimens") != current.get("specimens"):
+      lines.append("WARNING: the benchmarks may have been run on different specimens")
+  return lines, regressions
+
+def main(argv=None):
+  '''Command line interface'''
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  run_parser = subparsers.add_parser("run", help="run the benchmarks")
+  run_parser.add_argument("--output", default=DEFAULT_BASELINE)
+  compare_parser = subparsers.add_parser("compare", help="compare to a baseline")
+  compare_parser.add_argument("baseline")
+  compare_parser.add_argument(
+    "current", nargs="?", default=None,
+    help="results to compare (default: run the benchmarks)")
+  compare_parser.add_argument("--threshold", type=float, default=0.2)
+  compare_parser.add_argument("--output", default=None, help="save the new results")
+  for p in (run_parser, compare_parser):
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument(
+      "--quick", action="store_true",
+      help="end-to-end benchmarks of the smallest specimen only (the "
+      "micro-benchmarks are unchanged)")
+  args = parser.parse_args(argv)
+  configure_logging("WARNING")
+
+  if args.command == "run":
+    save_results(run_benchmarks(args.repeat, args.quick), args.output)
+    return 0
+
+  with open(args.baseline, "r", encoding="utf-8") as file:
+    baseline = json.load(file)
+  if args.current is None:
+    current = run_benchmarks(args.repeat, args.quick)
+    if args.output is not None:
+      save_results(current, args.output)
+  else:
+    with open(args.current, "r", encoding="utf-8") as file:
+      current = json.load(file)
+  lines, regressions = compare_results(baseline, current, args.threshold)
+  print("\n".join(lines))
+  if regressions:
+    print(f"{len(regressions)} regression(s) above {args.threshold:.0%}")
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,110 @@
+'''Command line entry point of the analyses
+
+Usage:
+  python cli.py [--data-dir DIR] COMMAND [options]
+with COMMAND one of
+  annotations     compile the annotation store (annotation_store.py)
+  area-length     section areas and lengths (1_section_area_length.py)
+  gyral           folial widths and perimeters (2_figure3_folial_width_perimeter.py)
+  thickness       molecular layer thicknesses (3_figure4_thickness.py)
+  benchmarks      benchmarks of the gyri and thickness functions (benchmarks.py)
+  synthetic       synthetic specimens and stress tests (synthetic_cerebellum.py)
+  queue           distributed processing through a work queue (work_queue.py)
+  sweep           parameter sweeps of the measurements (parameter_sweep.py)
+  startup-times   cold start time of each command
+The options of each command are those of its script, see
+  python cli.py COMMAND --help
+The data directory defaults to the data directory of the repository, or
+to the CB_DATA_DIR environment variable. The module of a command is only
+imported when the command is run, and imports its heavy dependencies
+(scikit-learn, scikit-image) only when needed.
+'''
+
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import dataset
+
+COMMANDS = {
+  "annotations": "annotation_store",
+  "area-length": "1_section_area_length",
+  "gyral": "2_figure3_folial_width_perimeter",
+  "thickness": "3_figure4_thickness",
+  "benchmarks": "benchmarks",
+  "synthetic": "synthetic_cerebellum",
+  "queue": "work_queue",
+  "sweep": "parameter_sweep"
+}
+
+# dependencies whose import is reported by startup-times
+HEAVY_MODULES = ["pandas", "scipy.signal", "skimage.io", "skimage.measure", "sklearn", "matplotlib"]
+
+_IMPORT_TIME = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({"time": elapsed, "heavy": [m for m in sys.argv[2:] if m in sys.modules]}))
+'''
+
+def startup_times(repeat=5):
+  '''Cold import time of the module of each command, each import in a new
+  interpreter
+  Returns
+  -------
+  dict
+    for each command, minimum and median import time (s) and the heavy
+    dependencies imported
+  '''
+  src_dir = os.path.dirname(os.path.abspath(__file__))
+  times = {}
+  for command, module in COMMANDS.items():
+    runs = []
+    for _ in range(repeat):
+      output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_TIME, module, *HEAVY_MODULES],
+        cwd=src_dir, check=True, capture_output=True, text=True).stdout
+      runs.append(json.loads(output.splitlines()[-1]))
+    elapsed = [run["time"] for run in runs]
+    times[command] = {
+      "min": min(elapsed), "median": statistics.median(elapsed),
+      "heavy": runs[-1]["heavy"]}
+  return times
+
+def main(argv=None):
+  '''Run a command'''
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument(
+    "--data-dir", default=None,
+    help="data directory, containing raw and derived (default: "
+    f"{dataset.data_dir()})")
+  parser.add_argument("command", choices=[*COMMANDS, "startup-times"])
+  parser.add_argument("args", nargs=argparse.REMAINDER, help="options of the command")
+  args = parser.parse_args(argv)
+  if args.data_dir is not None:
+    dataset.set_data_dir(args.data_dir)
+
+  if args.command == "startup-times":
+    times_parser = argparse.ArgumentParser(prog="cli.py startup-times")
+    times_parser.add_argument("--repeat", type=int, default=5)
+    times_parser.add_argument("--json", action="store_true", help="print the times as JSON")
+    times_args = times_parser.parse_args(args.args)
+    times = startup_times(times_args.repeat)
+    if times_args.json:
+      print(json.dumps(times, indent=1))
+      return 0
+    print(f"{'command':<15} {'min (s)':>8} {'median (s)':>11}  heavy imports")
+    for command, t in times.items():
+      print(f"{command:<15} {t['min']:8.2f} {t['median']:11.2f}  {', '.join(t['heavy']) or '-'}")
+    return 0
+
+  module = importlib.import_module(COMMANDS[args.command])
+  return module.main(args.args) or 0
+
+if __name__ == "__main__":
+  sys.exit(main())
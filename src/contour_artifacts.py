@@ -0,0 +1,200 @@
+'''Intermediate results on a cerebellum contour, shared by the gyri and
+thickness stages
+
+The exterior ring of each polygon of the contour is subdivided once, in
+the coordinates of the annotation. The gyri stage resamples the largest
+ring and computes its multi-scale curvature features and KMeans labels;
+the thickness stage scales the rings to the image, resamples them and
+computes their normals. Each artifact is kept in memory, and if an
+image_cache.ImageCache is provided, saved as compact arrays under a key
+combining the specimen, a hash of its contour and the parameters, so that
+the other stage, a rerun or a later analysis reuses it:
+  artifacts = ContourArtifacts(cb_mid, name, cache)
+  polys, min_length = artifacts.gyri_contour()
+  labels, sulci_index, gyri_index, wall_index = artifacts.gyri_labels()
+Lists of arrays (one per polygon) are stored concatenated, with offsets.
+'''
+
+import hashlib
+import logging
+import numpy as np
+import shapely
+import contour_resampling as cr
+import gyri as gy
+from image_cache import cache_key
+
+log = logging.getLogger(__name__)
+
+# change when the computation of an artifact changes, to invalidate
+# previous cache entries
+ARTIFACTS_VERSION = 1
+
+def contour_hash(cb_mid):
+  '''sha256 of a contour, from its WKB representation'''
+  return hashlib.sha256(shapely.to_wkb(cb_mid)).hexdigest()
+
+def pack_arrays(arrays, shape=(2,)):
+  '''Concatenate a list of arrays along their first axis
+  Returns
+  -------
+  data : np.array
+    concatenated arrays
+  offsets : np.array
+    start of each array in data, followed by the length of data
+  '''
+  offsets = np.cumsum([0] + [len(a) for a in arrays])
+  if len(arrays) == 0:
+    return np.zeros((0, *shape)), offsets
+  return np.concatenate(arrays), offsets
+
+def unpack_arrays(data, offsets):
+  '''List of arrays packed by pack_arrays'''
+  return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+class ContourArtifacts:
+  '''Intermediate results on a contour, computed once
+  Parameters
+  ----------
+  cb_mid : shapely.geometry.MultiPolygon
+    cerebellum contour, in annotation coordinates
+  name : str
+    name of the specimen
+  cache : image_cache.ImageCache
+    if provided, artifacts are read from and saved to this cache
+  '''
+
+  def __init__(self, cb_mid, name=None, cache=None):
+    self.cb_mid = cb_mid
+    self.name = name
+    self.cache = cache
+    self.hash = contour_hash(cb_mid)
+    self.arrays = {}
+
+  def artifact(self, kind, params, compute):
+    '''Arrays of an artifact, from memory, from the cache, or computed
+    Parameters
+    ----------
+    kind : str
+      name of the artifact
+    params : list
+      parameters of the computation, json serialisable
+    compute : callable
+      function without arguments returning a dictionary of arrays
+    Returns
+    -------
+    dict
+      arrays of the artifact
+    '''
+    key = cache_key(ARTIFACTS_VERSION, kind, self.name, self.hash, params)
+    if key in self.arrays:
+      return self.arrays[key]
+    arrays = None
+    if self.cache is not None:
+      arrays = self.cache.load(key)
+    if arrays is None:
+      arrays = compute()
+      if self.cache is not None:
+        self.cache.save(key, arrays)
+    self.arrays[key] = arrays
+    return arrays
+
+  def polygons(self):
+    '''Polygons of the contour'''
+    return list(getattr(self.cb_mid, "geoms", [self.cb_mid]))
+
+  def rings(self):
+    '''Exterior ring of each polygon subdivided by
+    contour_resampling.subdivided_ring'''
+    def compute():
+      data, offsets = pack_arrays([
+        cr.subdivided_ring(np.array(p.exterior.coords)) for p in self.polygons()])
+      return {"rings": data, "offsets": offsets}
+    arrays = self.artifact("rings", [], compute)
+    return unpack_arrays(arrays["rings"], arrays["offsets"])
+
+  def gyri_contour(self, n_points=None):
+    '''Largest polygon resampled by gyri.resample_cerebellum_contour
+    Returns
+    -------
+    polys : np.array
+      resampled polygon coordinates
+    min_length : float
+      distance between resampled vertices
+    '''
+    def compute():
+      polys, min_length = gy.resample_cerebellum_contour(
+        self.cb_mid, n_points, rings=self.rings())
+      return {"polys": polys, "min_length": np.array(min_length)}
+    arrays = self.artifact("gyri_contour", [n_points], compute)
+    return np.asarray(arrays["polys"]), float(arrays["min_length"])
+
+  def gyri_features(self, n_points=None, iters=10):
+    '''gyri.contour_features of the gyri_contour'''
+    def compute():
+      return {"features": gy.contour_features(self.gyri_contour(n_points)[0], iters)}
+    return np.asarray(self.artifact("gyri_features", [n_points, iters], compute)["features"])
+
+  def gyri_labels(self, n_points=None, iters=10, n_clusters=3):
+    '''gyri.label_contour of the gyri_contour. KMeans clustering is not
+    deterministic: cached labels are reused as they were first computed
+    Returns
+    -------
+    labels : np.array
+      labels for each vertex
+    sulci_index, gyri_index, wall_index : int
+      index of the sulci, gyri and wall labels
+    '''
+    def compute():
+      labels, *indices = gy.label_contour(
+        self.gyri_contour(n_points)[0], iters, self.gyri_features(n_points, iters),
+        n_clusters)
+      return {"labels": labels, "indices": np.array(indices)}
+    arrays = self.artifact("gyri_labels", [n_points, iters, n_clusters], compute)
+    return (np.asarray(arrays["labels"]), *(int(i) for i in arrays["indices"]))
+
+  def thickness_contours(self, img_width, scale_row, origin, min_length, profile_length=30):
+    '''Polygons scaled to the image, resampled as thickness.resample_contour
+    does, and the end points of their normals
+    Parameters
+    ----------
+    img_width : int
+      width of the whole image (px)
+    scale_row : float
+      scale of the specimen
+    origin : np.array
+      image coordinates of the corner of the cropped image
+    min_length : float
+      distance between resampled vertices, in svg dimensions
+    profile_length : int
+      length of the normals (px)
+    Returns
+    -------
+    contours : list of np.array
+      resampled coordinates of each polygon, in cropped image
+      coordinates. Empty for polygons that could not be resampled
+    normals : list of np.array
+      contour_resampling.polygon_normals of each resampled polygon
+    '''
+    def compute():
+      g = (img_width/1000)/scale_row
+      contours, normals = [], []
+      for ring in self.rings():
+        try:
+          pp, _ = cr.resample_subdivided_ring(
+            ring*g - origin, min_length, length_scale=1000/img_width)
+          end = cr.polygon_normals(pp, profile_length=profile_length)
+        except Exception as err: # pylint: disable=broad-except
+          log.error("ERR3: %s", err)
+          pp, end = np.zeros((0, 2)), np.zeros((0, 2))
+        contours.append(pp)
+        normals.append(end)
+      contours, offsets = pack_arrays(contours)
+      return {"contours": contours, "normals": pack_arrays(normals)[0], "offsets": offsets}
+    arrays = self.artifact(
+      "thickness_contours",
+      [int(img_width), float(scale_row), [float(x) for x in origin], float(min_length),
+        profile_length],
+      compute)
+    return (
+      unpack_arrays(np.asarray(arrays["contours"]), arrays["offsets"]),
+      unpack_arrays(np.asarray(arrays["normals"]), arrays["offsets"]))
@@ -0,0 +1,145 @@
+'''Resample closed contours at regular arc-length intervals, and compute
+the normals of their vertices'''
+
+import numpy as np
+
+def gyri_min_length(contour_length):
+  '''Distance between vertices used for folding measurements, scaled
+  with the (log) length of the contour'''
+  better_min_length = -3 + (np.log10(contour_length)+0.56)/3.1
+  return 10**better_min_length
+
+def thickness_min_length(contour_length):
+  '''Distance between vertices used for thickness measurements'''
+  return contour_length**0.3/10
+
+def subdivided_ring(poly):
+  '''Smooth a polygon with a cubic B-spline subdivision and return it as
+  a closed ring (last vertex equal to the first)
+  Parameters
+  ----------
+  poly : np.array
+    polygon coordinates
+  Returns
+  -------
+  ring : np.array
+    closed ring coordinates
+  '''
+  # imported here to keep the import of the module fast
+  from skimage.measure import subdivide_polygon # pylint: disable=import-outside-toplevel
+  ring = subdivide_polygon(np.asarray(poly), degree=3)
+  if not np.array_equal(ring[0], ring[-1]):
+    ring = np.concatenate([ring, ring[:1]])
+  return ring
+
+def ring_arc_length(ring):
+  '''Cumulative arc length at each vertex of a closed ring'''
+  seg_length = np.sqrt(np.sum(np.diff(ring, axis=0)**2, axis=1))
+  return np.concatenate([[0], np.cumsum(seg_length)])
+
+def resample_ring(ring, n_points, arc_length=None):
+  '''Place n_points vertices at regular arc-length intervals along a ring,
+  starting from its first vertex
+  Parameters
+  ----------
+  ring : np.array
+    closed ring coordinates
+  n_points : int
+    number of points to resample to
+  arc_length : np.array
+    cumulative arc length of the ring, computed if not provided
+  Returns
+  -------
+  points : np.array
+    resampled coordinates, shape (n_points, 2)
+  '''
+  if arc_length is None:
+    arc_length = ring_arc_length(ring)
+  distance = np.arange(n_points)/n_points * arc_length[-1]
+  seg = np.searchsorted(arc_length, distance, side="right") - 1
+  seg = np.clip(seg, 0, len(ring) - 2)
+  seg_length = arc_length[seg + 1] - arc_length[seg]
+  t = np.divide(
+    distance - arc_length[seg], seg_length,
+    out=np.zeros(n_points), where=seg_length > 0)
+  return ring[seg] + t[:, np.newaxis]*(ring[seg + 1] - ring[seg])
+
+def resample_polygon(poly, min_length=None, n_points=None, length_scale=1):
+  '''Subdivide a polygon and resample it with vertices separated by
+  min_length, or with n_points vertices
+  Parameters
+  ----------
+  poly : np.array
+    polygon coordinates
+  min_length : float
+    distance between resampled vertices, in units of the polygon
+    coordinates multiplied by length_scale
+  n_points : int
+    number of points to resample to. Overrides min_length
+  length_scale : float
+    factor converting polygon coordinates into min_length units
+  Returns
+  -------
+  points : np.array
+    resampled coordinates
+  min_length : float
+    distance between resampled vertices
+  '''
+  return resample_subdivided_ring(subdivided_ring(poly), min_length, n_points, length_scale)
+
+def resample_subdivided_ring(ring, min_length=None, n_points=None, length_scale=1):
+  '''Resample a ring returned by subdivided_ring, as resample_polygon does
+  for the polygon'''
+  arc_length = ring_arc_length(ring)
+  ring_length = arc_length[-1] * length_scale
+  if n_points:
+    min_length = ring_length/n_points
+  else:
+    n_points = int(np.ceil(ring_length/min_length))
+  return resample_ring(ring, n_points, arc_length), min_length
+
+def mid_vector(v1, v2):
+  '''compute the angle and the vector between two vectors'''
+  v1 = v1/np.linalg.norm(v1)
+  v2 = v2/np.linalg.norm(v2)
+  v1t = np.array([-v1[1], v1[0]])
+  x = v2.dot(v1)
+  y = v2.dot(v1t)
+  ang12 = np.arctan2(y, x)
+  r = v1*np.cos(ang12/2) + v1t*np.sin(ang12/2)
+  return ang12, r
+
+def mid_vectors(v1, v2):
+  '''compute the angles and the vectors between two arrays of vectors
+  (vectorised version of mid_vector for arrays of shape (n, 2))'''
+  v1 = v1/np.linalg.norm(v1, axis=1)[:, np.newaxis]
+  v2 = v2/np.linalg.norm(v2, axis=1)[:, np.newaxis]
+  v1t = np.stack([-v1[:, 1], v1[:, 0]], axis=1)
+  x = np.sum(v2*v1, axis=1)
+  y = np.sum(v2*v1t, axis=1)
+  ang12 = np.arctan2(y, x)
+  r = v1*np.cos(ang12/2)[:, np.newaxis] + v1t*np.sin(ang12/2)[:, np.newaxis]
+  return ang12, r
+
+def polygon_normals(poly, profile_length = 5):
+  '''compute normal vectors for each point in the polygon'''
+  a = np.roll(poly, 1, axis=0)
+  c = np.roll(poly, -1, axis=0)
+  v1 = np.stack([a[:, 1] - poly[:, 1], -(a[:, 0] - poly[:, 0])], axis=1)
+  v2 = np.stack([-(c[:, 1] - poly[:, 1]), c[:, 0] - poly[:, 0]], axis=1)
+  _, normal = mid_vectors(v1, v2)
+  return poly - profile_length * normal
+
+def polygon_resample(poly, normals, profile_length=5, max_ang = np.pi/6):
+  '''improve sampling by comparing the angle between consecutive normal vectors'''
+
+  directions = normals - poly
+  ang, new_normal = mid_vectors(np.roll(directions, 1, axis=0), directions)
+  where = np.flatnonzero(np.abs(ang) > max_ang)
+  if len(where):
+    new_poly_points = (poly[where] + np.roll(poly, 1, axis=0)[where])/2
+    return (
+      np.insert(poly, where, new_poly_points, axis=0),
+      np.insert(normals, where, new_poly_points + profile_length * new_normal[where], axis=0)
+    )
+  return poly, normals
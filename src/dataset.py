@@ -0,0 +1,50 @@
+'''Location of the raw and derived data, and the table of specimens
+
+The data directory defaults to the data directory of the repository, and
+can be changed with the CB_DATA_DIR environment variable or set_data_dir
+(the --data-dir option of cli.py).
+'''
+
+import functools
+import os
+
+_data_dir = os.environ.get("CB_DATA_DIR") or os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), os.pardir, "data")
+
+def set_data_dir(path):
+  '''Change the data directory, also for the child processes (such as
+  the workers of specimen_executor, which import this module again when
+  they are spawned)'''
+  global _data_dir # pylint: disable=global-statement
+  _data_dir = os.path.abspath(path)
+  os.environ["CB_DATA_DIR"] = _data_dir
+  load_dataset.cache_clear()
+
+def data_dir():
+  '''Data directory'''
+  return _data_dir
+
+def raw_path(*parts):
+  '''Path of a file in the raw data directory'''
+  return os.path.join(_data_dir, "raw", *parts)
+
+def derived_path(*parts):
+  '''Path of a file in the derived data directory'''
+  return os.path.join(_data_dir, "derived", *parts)
+
+@functools.lru_cache(maxsize=None)
+def load_dataset():
+  '''Table of specimens and their scales
+  Returns
+  -------
+  data : pandas.DataFrame
+    content of 01_cb_data.csv
+  scale : np.array
+    scale of each specimen (02_scale.csv), 0 if unavailable
+  '''
+  # imported here to keep the import of the module fast
+  import numpy as np # pylint: disable=import-outside-toplevel
+  import pandas as pd # pylint: disable=import-outside-toplevel
+  data = pd.read_csv(raw_path("01_cb_data.csv"))
+  scale = np.array(pd.read_csv(raw_path("02_scale.csv"))["Scale"])
+  return data, scale
@@ -0,0 +1,39 @@
+'''Compute geometric measurements of many sections at once'''
+
+import numpy as np
+import pandas as pd
+import shapely
+
+def geometry_metrics(geoms):
+  '''Compute area, length, bounds and convex hull measurements of an array
+  of geometries, each with a single vectorised shapely call
+  Parameters
+  ----------
+  geoms : np.array of shapely.geometry.MultiPolygon
+    sections
+  Returns
+  -------
+  pandas.DataFrame
+    one row per geometry with columns Area, Length (perimeter, holes
+    included), MinX, MinY, MaxX, MaxY, HullArea, HullLength (area and
+    perimeter of the convex hull) and FoldingIndex (ratio of the length to
+    the length of the convex hull)
+  '''
+  geoms = np.asarray(geoms, dtype=object)
+  bounds = shapely.bounds(geoms).reshape(-1, 4)
+  hulls = shapely.convex_hull(geoms)
+  length = shapely.length(geoms)
+  hull_length = shapely.length(hulls)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    folding_index = length/hull_length
+  return pd.DataFrame({
+    "Area": shapely.area(geoms),
+    "Length": length,
+    "MinX": bounds[:, 0],
+    "MinY": bounds[:, 1],
+    "MaxX": bounds[:, 2],
+    "MaxY": bounds[:, 3],
+    "HullArea": shapely.area(hulls),
+    "HullLength": hull_length,
+    "FoldingIndex": folding_index
+  })
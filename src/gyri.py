@@ -1,12 +1,12 @@
 '''compute gyral measurements for a contour'''
 
+import logging
 import numpy as np
 import shapely
 from shapely import affinity
-from shapely.geometry import LinearRing
-from sklearn.cluster import KMeans
-from skimage.measure import subdivide_polygon
-from scipy.signal import find_peaks
+import contour_resampling as cr
+
+log = logging.getLogger(__name__)
 
 def smooth_polygon(poly, iters=1):
   '''Smooth polygon by averaging with its neighbours
@@ -26,6 +26,28 @@ def smooth_polygon(poly, iters=1):
     poly = (poly + np.roll(poly, -1, axis=0) + np.roll(poly, 1, axis=0))/3
   return poly
 
+def smooth_polygon_scales(poly, iters_list):
+  '''Smooth polygon for several numbers of iterations at once.
+  Repeated averaging with the neighbours is a circular convolution, which
+  multiplies the Fourier spectrum of the polygon by (1+2cos(w))/3 at each
+  iteration: all scales are computed from a single spectrum
+  Parameters
+  ----------
+  poly : np.array
+    polygon coordinates
+  iters_list : list of int
+    numbers of iterations
+  Returns
+  -------
+  polys : list of np.array
+    smoothed polygon coordinates for each number of iterations
+  '''
+  n = len(poly)
+  spectrum = np.fft.rfft(poly, axis=0)
+  gain = (1 + 2*np.cos(2*np.pi*np.arange(spectrum.shape[0])/n))/3
+  gain = gain.reshape(-1, *[1]*(np.ndim(poly) - 1))
+  return [np.fft.irfft(spectrum * gain**iters, n=n, axis=0) for iters in iters_list]
+
 def curvature_features(poly):
   '''Compute curvature measures: as 2nd derivative of poly, as cross product of
   tangent vectors, and a signed version of 2nd derivative
@@ -50,7 +72,7 @@ def curvature_features(poly):
   scurv = (curv * np.sign(cross))
   return curv, scurv, cross
 
-def resample_cerebellum_contour(cb_mid_row, n_points=None):
+def resample_cerebellum_contour(cb_mid_row, n_points=None, rings=None):
   '''Resample cerebellum contour taking into account its scaling with size
   Parameters
   ----------
@@ -58,6 +80,9 @@ def resample_cerebellum_contour(cb_mid_row, n_points=None):
     cerebellum contour
   n_points : int
     number of points to resample to
+  rings : list of np.array
+    if provided, exterior ring of each polygon of the contour already
+    subdivided by contour_resampling.subdivided_ring
   Returns
   -------
   poly2 : np.array
@@ -67,32 +92,52 @@ def resample_cerebellum_contour(cb_mid_row, n_points=None):
   '''
 
   scaled_mpoly = affinity.scale(cb_mid_row, xfact=1, yfact=1, origin=(0,0))
-  print("Polygon length:", scaled_mpoly.length)
+  log.debug("Polygon length: %s", scaled_mpoly.length)
 
   if isinstance(scaled_mpoly, shapely.geometry.polygon.Polygon):
+    p_index = 0
     poly = np.array(scaled_mpoly.exterior.coords)
   else:
     p_index = np.argmax([np.array(p.exterior.coords).shape[0] for p in scaled_mpoly.geoms])
     poly = np.array(scaled_mpoly.geoms[p_index].exterior.coords)
-  poly2 = subdivide_polygon(poly, degree=3)
-  ring = LinearRing(poly2)
-  ring_length = ring.length
-  print("Ring length:", ring_length)
+  ring = cr.subdivided_ring(poly) if rings is None else rings[p_index]
+  arc_length = cr.ring_arc_length(ring)
+  ring_length = arc_length[-1]
+  log.debug("Ring length: %s", ring_length)
 
   if n_points:
     min_length = ring_length/n_points
   else:
-    better_min_length = -3 + (np.log10(scaled_mpoly.length)+0.56)/3.1
-    min_length = 10**better_min_length
+    min_length = cr.gyri_min_length(scaled_mpoly.length)
     n_points = int(np.ceil(ring_length/min_length))
 
-  polys = np.zeros((n_points, 2))
-  for i in range(n_points):
-    polys[i, :] = np.array(ring.interpolate(i/n_points, normalized=True).coords)
+  polys = cr.resample_ring(ring, n_points, arc_length)
 
   return polys, min_length
 
-def label_contour(polys, iters=10):
+def contour_features(polys, iters=10):
+  '''Curvature features of the contour vertices at several scales
+  Parameters
+  ----------
+  polys : np.array
+    polygon coordinates
+  iters : int
+    number of scales: the polygon, and the polygon smoothed with
+    10*2**i iterations for i in 1..iters-1
+  Returns
+  -------
+  features : np.array
+    curvature_features of each scale, shape (len(polys), 3*(iters+1)).
+    The last 3 columns are zero
+  '''
+  features = np.zeros((len(polys), 3*(iters+1)))
+  features[:, 0], features[:, 1], features[:, 2] = curvature_features(polys)
+  scales = smooth_polygon_scales(polys, [10*2**i for i in range(1, iters)])
+  for i, polys1 in enumerate(scales, start=1):
+    features[:, 3*i], features[:, 3*i+1], features[:, 3*i+2] = curvature_features(polys1)
+  return features
+
+def label_contour(polys, iters=10, features=None, n_clusters=3):
   '''Label contour vertices in 3 classes: sulci, gyri and wall
   Parameters
   ----------
@@ -100,6 +145,11 @@ def label_contour(polys, iters=10):
     polygon coordinates
   iters : int
     number of iterations for smoothing
+  features : np.array
+    if provided, contour_features(polys, iters) already computed
+  n_clusters : int
+    number of KMeans clusters. The clusters of highest and lowest mean
+    cross product are the sulci and gyri, the others are walls
   Returns
   -------
   labels : np.array
@@ -109,22 +159,20 @@ def label_contour(polys, iters=10):
   gyri_index : int
     index of gyri label
   wall_index : int
-    index of wall label
+    index of wall label (the first one if n_clusters > 3)
   '''
-  # compute features
-  features = np.zeros((len(polys), 3*(iters+1)))
-  features[:, 0], features[:, 1], features[:, 2] = curvature_features(polys)
-  for i in range(1, iters):
-    polys1 = smooth_polygon(polys, 10*2**i)
-    features[:, 3*i], features[:, 3*i+1], features[:, 3*i+2] = curvature_features(polys1)
-  kmclustering = KMeans(n_clusters=3)
+  if features is None:
+    features = contour_features(polys, iters)
+  # imported here to keep the import of the module fast
+  from sklearn.cluster import KMeans # pylint: disable=import-outside-toplevel
+  kmclustering = KMeans(n_clusters=n_clusters)
   kmclustering.fit(features)
 
   # label vertices with kmeans clustering
   labels = kmclustering.labels_
-  sulci_index = np.argmax([np.mean(features[labels==label,2]) for label in [0, 1, 2]])
-  gyri_index = np.argmin([np.mean(features[labels==label,2]) for label in [0, 1, 2]])
-  tmp = [0, 1, 2]
+  sulci_index = np.argmax([np.mean(features[labels==label,2]) for label in range(n_clusters)])
+  gyri_index = np.argmin([np.mean(features[labels==label,2]) for label in range(n_clusters)])
+  tmp = list(range(n_clusters))
   tmp.remove(sulci_index)
   tmp.remove(gyri_index)
   wall_index = tmp[0]
@@ -144,14 +192,68 @@ def filter_sulci(labels, sulci_index):
   filtered_labels : np.array
     filtered labels for each vertex
   '''
-  labels = np.array([1 if x==sulci_index else 0 for x in labels])
+  labels = (np.asarray(labels) == sulci_index).astype(int)
   filtered_labels = labels + np.roll(labels, -1) + np.roll(labels, 1)
   filtered_labels = smooth_polygon(filtered_labels, iters=100)
+  from scipy.signal import find_peaks # pylint: disable=import-outside-toplevel
   peaks = find_peaks(filtered_labels)
   filtered_labels[:] = 0
   filtered_labels[peaks[0]] = 1
   return filtered_labels
 
+FOLD_DTYPE = np.dtype([
+  ("sulcus_start", np.int64),
+  ("sulcus_end", np.int64),
+  ("start", np.int64),
+  ("end", np.int64),
+  ("period", np.float64),
+  ("width", np.float64),
+  ("arc_start", np.float64),
+  ("arc_end", np.float64)
+])
+
+def segment_folds(labels, sulci_index, polys, min_length):
+  '''Segment the contour into folds going from one sulcus to the next
+  Sulci are runs of consecutive vertices labelled sulci_index. A fold starts
+  at the first vertex after a sulcus and ends at the first vertex after the
+  next sulcus.
+  Parameters
+  ----------
+  labels : np.array
+    labels for each vertex
+  sulci_index : int
+    index of sulci label
+  polys : np.array
+    polygon coordinates
+  min_length : float
+    length between two vertices
+  Returns
+  -------
+  folds : np.array
+    structured array of dtype FOLD_DTYPE with one record per fold:
+    index of the first vertex of the sulci at the start and end of the fold
+    (sulcus_start, sulcus_end), vertex indices of the start and end of the
+    fold (start, end), gyral period (length along the contour), gyral width
+    (euclidean distance), and arc length at the start and end of the fold
+    (arc_start, arc_end)
+  '''
+  is_sulcus = np.concatenate([[0], np.asarray(labels) == sulci_index, [0]]).astype(np.int8)
+  change = np.diff(is_sulcus)
+  run_start = np.flatnonzero(change == 1)
+  run_end = np.flatnonzero(change == -1)
+
+  folds = np.zeros(max(len(run_start) - 1, 0), dtype=FOLD_DTYPE)
+  folds["sulcus_start"] = run_start[:-1]
+  folds["sulcus_end"] = run_start[1:]
+  folds["start"] = run_end[:-1]
+  folds["end"] = run_end[1:]
+  folds["period"] = (folds["end"] - folds["start"]) * min_length
+  folds["width"] = np.linalg.norm(
+    polys[folds["end"] % len(polys)] - polys[folds["start"] % len(polys)], axis=1)
+  folds["arc_start"] = folds["start"] * min_length
+  folds["arc_end"] = folds["end"] * min_length
+  return folds
+
 def compute_gyral_period(labels, sulci_index, min_length):
   '''Compute the period of gyri, defined as the length along the
   contour from one sulcus to the next
@@ -166,21 +268,10 @@ def compute_gyral_period(labels, sulci_index, min_length):
   Returns
   -------
   period : list
-    list of gyral periods
+    list of gyral periods, followed by a 0 marking the end of the contour
   '''
-  pos = np.argmax(labels == sulci_index)
-  pos += np.argmax(labels[pos:] != sulci_index)
-  period = []
-  while True:
-    pos0 = pos
-    pos1 = np.argmax(labels[pos:] == sulci_index)
-    pos2 = np.argmax(labels[pos+pos1:] != sulci_index)
-    pos += pos1 + pos2
-    period.append((pos1+pos2) * min_length)
-    if pos == pos0:
-      break
-    pos0 = pos
-  return period
+  folds = segment_folds(labels, sulci_index, np.zeros((len(labels), 2)), min_length)
+  return [*folds["period"], 0]
 
 def compute_gyral_width(labels, sulci_index, polys):
   '''Compute the width of gyri, defined as the euclidean distance
@@ -196,18 +287,7 @@ def compute_gyral_width(labels, sulci_index, polys):
   Returns
   -------
   width : list
-    list of gyral widths
+    list of gyral widths, followed by a 0 marking the end of the contour
   '''
-  pos = np.argmax(labels == sulci_index)
-  pos += np.argmax(labels[pos:] != sulci_index)
-  width = []
-  while True:
-    pos0 = pos
-    pos1 = np.argmax(labels[pos:] == sulci_index)
-    pos2 = np.argmax(labels[pos+pos1:] != sulci_index)
-    width.append(np.linalg.norm(polys[pos + pos1+pos2] - polys[pos0]))
-    pos += pos1 + pos2
-    if pos == pos0:
-      break
-    pos0 = pos
-  return width
+  folds = segment_folds(labels, sulci_index, polys, 1)
+  return [*folds["width"], 0]
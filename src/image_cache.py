@@ -0,0 +1,122 @@
+'''On-disk cache of preprocessed images, stored as memory-mapped .npy arrays'''
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# change when preprocessing changes, to invalidate previous entries
+CACHE_VERSION = 1
+
+def file_hash(path, chunk_size=2**20):
+  '''sha256 of the content of a file'''
+  sha = hashlib.sha256()
+  with open(path, "rb") as file:
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+def cache_key(*parts):
+  '''Key combining file hashes and processing parameters'''
+  text = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ImageCache:
+  '''Cache of numpy arrays in a directory, one subdirectory per entry
+  Arrays are opened memory-mapped and read-only. When the total size of
+  the cache exceeds max_bytes, the least recently used entries are
+  removed.
+  Parameters
+  ----------
+  root : str
+    cache directory
+  max_bytes : int
+    maximum size of the cache
+  '''
+
+  def __init__(self, root, max_bytes=8*2**30):
+    self.root = root
+    self.max_bytes = max_bytes
+
+  def _path(self, key):
+    return os.path.join(self.root, key)
+
+  def load(self, key):
+    '''Return a dictionary of memory-mapped arrays, or None if the
+    entry is not in the cache'''
+    path = self._path(key)
+    try:
+      names = [f for f in os.listdir(path) if f.endswith(".npy")]
+      arrays = {
+        name[:-4]: np.load(os.path.join(path, name), mmap_mode="r")
+        for name in names
+      }
+      # mark as recently used
+      os.utime(path)
+    except (FileNotFoundError, ValueError):
+      return None
+    return arrays
+
+  def save(self, key, arrays):
+    '''Store a dictionary of arrays and return them memory-mapped'''
+    os.makedirs(self.root, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+    try:
+      for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), np.asarray(array))
+      os.rename(tmp, self._path(key))
+    except OSError:
+      # entry written concurrently by another process
+      shutil.rmtree(tmp, ignore_errors=True)
+    self.evict(keep=key)
+    return self.load(key)
+
+  def entries(self):
+    '''List of (last use time, size in bytes, key) of all entries'''
+    result = []
+    if not os.path.isdir(self.root):
+      return result
+    for key in os.listdir(self.root):
+      path = self._path(key)
+      if key.startswith(".tmp-"):
+        continue
+      try:
+        size = sum(
+          os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        result.append((os.path.getmtime(path), size, key))
+      except FileNotFoundError:
+        continue
+    return result
+
+  def evict(self, keep=None):
+    '''Remove least recently used entries until the cache fits in max_bytes'''
+    entries = sorted(self.entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in entries:
+      if total <= self.max_bytes:
+        break
+      if key == keep:
+        continue
+      shutil.rmtree(self._path(key), ignore_errors=True)
+      total -= size
+
+def add_cache_arguments(parser):
+  '''Add the --cache-dir and --cache-size options to an argparse parser'''
+  parser.add_argument(
+    "--cache-dir", default=None,
+    help="directory where preprocessed images and contour artifacts "
+    "(resampled contours, curvature features, labels) are cached, and "
+    "shared between the scripts")
+  parser.add_argument(
+    "--cache-size", type=float, default=8,
+    help="maximum size of the cache in GB (default: 8)")
+  return parser
+
+def open_cache(args):
+  '''ImageCache of the parsed --cache-dir and --cache-size options, None
+  if no cache directory was given'''
+  if not args.cache_dir:
+    return None
+  return ImageCache(args.cache_dir, int(args.cache_size*2**30))
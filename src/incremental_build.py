@@ -0,0 +1,158 @@
+'''Incremental rebuild of the derived data
+
+For each stage, a manifest records a hash of the inputs of each specimen
+(annotation and image files, rows of 01_cb_data.csv and 02_scale.csv,
+code version and stage parameters) together with its result. Only the
+specimens whose inputs changed are recomputed, and the derived files are
+assembled from the results of the manifest.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+from dataset import derived_path
+from image_cache import file_hash
+from specimen_executor import map_specimens
+
+log = logging.getLogger(__name__)
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# umask of the process, read once: setting it is not thread safe
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+def input_hash(files=(), values=()):
+  '''Hash of the content of a list of files (None for missing files) and
+  of a list of json-serialisable values'''
+  hashes = [file_hash(path) if os.path.exists(path) else None for path in files]
+  text = json.dumps([hashes, list(values)], sort_keys=True, default=str)
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def code_version(names):
+  '''Hash of the source files of a stage, given by their names in the
+  src directory'''
+  return input_hash(files=[os.path.join(SRC_DIR, name) for name in sorted(names)])
+
+def file_mode(path):
+  '''Permissions of a file written to path: those of the file it replaces,
+  or the default permissions of a new file. Temporary files are created
+  readable by their owner only, and would otherwise keep these'''
+  try:
+    return stat.S_IMODE(os.stat(path).st_mode)
+  except FileNotFoundError:
+    return 0o666 & ~_UMASK
+
+def atomic_write(path, write):
+  '''Call write(file) on a temporary file, then move it to path'''
+  directory = os.path.dirname(os.path.abspath(path))
+  os.makedirs(directory, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+  try:
+    os.fchmod(fd, file_mode(path))
+    with os.fdopen(fd, "w", encoding="utf-8", newline="") as file:
+      write(file)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+
+def atomic_write_csv(data_frame, path):
+  '''Save a pandas data frame as csv, atomically'''
+  atomic_write(path, data_frame.to_csv)
+
+class Manifest:
+  '''Input hashes and results of the specimens of a stage
+  Parameters
+  ----------
+  path : str
+    json file where the manifest is saved
+  '''
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    if os.path.exists(path):
+      with open(path, "r", encoding="utf-8") as file:
+        self.entries = json.load(file)["entries"]
+
+  def is_current(self, key, digest):
+    '''Whether the result of a specimen was computed from the same inputs'''
+    return key in self.entries and self.entries[key]["hash"] == digest
+
+  def result(self, key):
+    '''Recorded result of a specimen'''
+    return self.entries[key]["result"]
+
+  def update(self, key, digest, result):
+    '''Record the result of a specimen'''
+    self.entries[key] = {"hash": digest, "result": result}
+
+  def retain(self, keys):
+    '''Forget the specimens that are not in keys'''
+    keys = set(keys)
+    self.entries = {k: v for k, v in self.entries.items() if k in keys}
+
+  def save(self):
+    '''Save the manifest, atomically'''
+    atomic_write(self.path, lambda file: json.dump(
+      {"entries": self.entries}, file, indent=1, sort_keys=True))
+
+def run_incremental(func, tasks, keys, digests, manifest, n_workers=1, **options):
+  '''Apply func to the tasks whose inputs changed, and return the results
+  of all tasks
+  Parameters
+  ----------
+  func : callable
+    top-level function processing one specimen. Its result must be
+    json-serialisable
+  tasks : list of tuple
+    arguments for each call to func
+  keys : list of str
+    key of each specimen in the manifest
+  digests : list of str
+    hash of the inputs of each specimen
+  manifest : Manifest
+    manifest of the stage, updated and saved. Specimens that are not in
+    keys are removed from it
+  n_workers : int
+    number of worker processes
+  options : dict
+    other options of map_specimens (report, load, prefetch...)
+  Returns
+  -------
+  results : list
+    result of each task, from the manifest if its inputs did not change.
+    None for tasks that failed
+  '''
+  todo = [i for i, (key, digest) in enumerate(zip(keys, digests))
+    if not manifest.is_current(key, digest)]
+  log.info("%d of %d specimens to compute", len(todo), len(tasks))
+  def record(index, result):
+    # save the manifest after each specimen, so that an interrupted run
+    # resumes where it stopped. Results are stored as they would be read
+    # back from json
+    manifest.update(keys[todo[index]], digests[todo[index]], json.loads(json.dumps(result)))
+    manifest.save()
+  _, errors = map_specimens(
+    func, [tasks[i] for i in todo], n_workers, labels=[keys[i] for i in todo],
+    on_result=record, **options)
+  failed = {label for label, _ in errors}
+  manifest.retain(keys)
+  manifest.save()
+  return [None if key in failed else manifest.result(key) for key in keys]
+
+def add_incremental_argument(parser):
+  '''Add the --incremental option to an argparse parser'''
+  parser.add_argument(
+    "--incremental", action="store_true",
+    help="only recompute specimens whose inputs changed since the last run, "
+    "using the manifests in data/derived/manifest")
+  return parser
+
+def manifest_path(stage):
+  '''Path of the manifest of a stage'''
+  return derived_path("manifest", f"{stage}.json")
@@ -0,0 +1,277 @@
+'''Parameter sweeps of the gyral and thickness measurements
+
+A sweep measures each specimen for every combination of a grid of
+parameters, and saves a tidy table with one row per specimen and
+combination:
+  python parameter_sweep.py gyral --grid iters=5,10,20 n_clusters=3,4
+  python parameter_sweep.py thickness --grid prominence=0.02,0.05,0.1 \
+    level=0.4,0.5,0.6 total_steps=30,40 [--output FILE]
+Parameters:
+  gyral      iters, n_clusters (gyri.label_contour)
+  thickness  profile_length, data_steps, total_steps, step_length
+             (thickness.get_profile_lines), prominence, level
+             (thickness.molecular_layer_thickness)
+Parameters not in the grid keep their default value.
+
+The measurement of a stage is a chain of steps, each depending on the
+result of the previous one and on some of the parameters. Combinations
+are enumerated with the parameters of the first steps varying slowest,
+and the result of a step is reused while its parameters and those of the
+steps before it do not change: the image preprocessing, mask and
+gradients are computed once per specimen, the profiles once per
+combination of the profile parameters, the curvature features once per
+number of iterations.
+'''
+
+import argparse
+import importlib
+import itertools
+import logging
+import numpy as np
+import pandas as pd
+import thickness as th
+from annotation_store import add_annotations_argument
+from contour_artifacts import ContourArtifacts
+from dataset import load_dataset, derived_path
+from image_cache import add_cache_arguments, open_cache
+from incremental_build import atomic_write
+from run_report import stage, start_run, add_report_arguments
+from specimen_executor import map_specimens, add_workers_argument
+
+log = logging.getLogger(__name__)
+
+# stage and default value of each parameter
+PARAMETERS = {
+  "iters": ("gyral", 10),
+  "n_clusters": ("gyral", 3),
+  "profile_length": ("thickness", 30),
+  "data_steps": ("thickness", 20),
+  "total_steps": ("thickness", 40),
+  "step_length": ("thickness", 0.5),
+  "prominence": ("thickness", 0.05),
+  "level": ("thickness", 0.5)
+}
+
+def _statistics(prefix, values):
+  return {
+    prefix + "Median": np.median(values), prefix + "Mean": np.mean(values),
+    prefix + "Std": np.std(values)}
+
+def _gyral_resample(state, _):
+  artifacts = ContourArtifacts(state["cb_mid"], state["name"], state["cache"])
+  with stage("resample") as info:
+    info["vertices"] = len(artifacts.gyri_contour()[0])
+  return {"artifacts": artifacts}
+
+def _gyral_features(state, params):
+  with stage("contour_features"):
+    state["artifacts"].gyri_features(iters=params["iters"])
+  return {}
+
+def _gyral_folds(state, params):
+  gyral = importlib.import_module("2_figure3_folial_width_perimeter")
+  period, width = gyral.measure_folds(
+    state["cb_mid"], state["artifacts"], params["iters"], params["n_clusters"])
+  return {"measurements": {
+    **_statistics("Period", period), **_statistics("Width", width),
+    "Folds": len(period) - 1}}
+
+def _thickness_prepare(state, _):
+  prepared = th.prepare_thickness(
+    state["scale_row"], state["cb_mid"], state["name"], state["img_path"],
+    roi_margin=state["roi_margin"], cache=state["cache"], img=state["img"])
+  if prepared is None:
+    return None
+  return {"prepared": prepared}
+
+def _thickness_profiles(state, params):
+  return {"profiles": th.trace_profiles(
+    state["prepared"], params["profile_length"], params["data_steps"],
+    params["total_steps"], params["step_length"])}
+
+def _thickness_boundaries(state, params):
+  measured = th.profile_thicknesses(
+    state["prepared"], state["profiles"], params["prominence"], params["level"])
+  if measured is None:
+    return None
+  return {"measurements": {
+    **_statistics("Thickness", measured["thickness"]),
+    "Profiles": len(measured["thickness"])}}
+
+# steps of each stage: name, parameters, and function(state, params)
+# returning the entries added to the state, or None if the measurement failed
+STEPS = {
+  "gyral": [
+    ("resample", [], _gyral_resample),
+    ("contour_features", ["iters"], _gyral_features),
+    ("measure_folds", ["n_clusters"], _gyral_folds)],
+  "thickness": [
+    ("prepare_thickness", [], _thickness_prepare),
+    ("trace_profiles", ["profile_length", "data_steps", "total_steps", "step_length"],
+      _thickness_profiles),
+    ("profile_thicknesses", ["prominence", "level"], _thickness_boundaries)]
+}
+
+def run_steps(steps, grid, state):
+  '''Evaluate a chain of steps for all combinations of a grid, reusing the
+  result of each step while its parameters and those of the previous steps
+  do not change
+  Parameters
+  ----------
+  steps : list of tuple
+    name, parameters and function of each step, see STEPS
+  grid : dict
+    list of values of each parameter of the steps
+  state : dict
+    input of the first step
+  Returns
+  -------
+  results : list of tuple
+    combination of parameters and final state, None if a step failed or
+    raised an exception
+  counts : dict
+    number of evaluations of each step
+  '''
+  names = [p for _, params, _ in steps for p in params]
+  # number of parameters of each step and of the steps before it
+  n_params = np.cumsum([len(params) for _, params, _ in steps])
+  current = [None]*len(steps)
+  counts = {name: 0 for name, _, _ in steps}
+  results = []
+  for values in itertools.product(*(grid[p] for p in names)):
+    combination = dict(zip(names, values))
+    value = state
+    for i, (name, _, func) in enumerate(steps):
+      key = values[:n_params[i]]
+      if current[i] is None or current[i][0] != key:
+        added = None
+        if value is not None:
+          counts[name] += 1
+          try:
+            added = func(value, combination)
+          except Exception as err: # pylint: disable=broad-except
+            log.warning("%s failed for %s: %s", name, dict(zip(names, key)), err)
+        current[i] = (key, None if added is None else {**value, **added})
+      value = current[i][1]
+    results.append((combination, value))
+  return results, counts
+
+def sweep_specimen(stage_name, row, source, scale_row, grid, options):
+  '''Measurements of a specimen for all combinations of a grid
+  Parameters
+  ----------
+  stage_name : str
+    "gyral" or "thickness"
+  row : int
+    row of the specimen in the dataset
+  source : str
+    URL of the specimen in MicroDraw
+  scale_row : float
+    scale of the specimen
+  grid : dict
+    list of values of each parameter of the stage
+  options : dict
+    annotations, cache and, for thickness, roi_margin
+  Returns
+  -------
+  list of dict
+    one row of the results table per combination, without measurements
+    for the combinations that failed
+  '''
+  if stage_name == "gyral":
+    gyral = importlib.import_module("2_figure3_folial_width_perimeter")
+    name, cb_mid = gyral.load_subject(row, source, options["annotations"])
+    state = {"name": name, "cb_mid": cb_mid, "cache": options["cache"]}
+  else:
+    thicknesses = importlib.import_module("3_figure4_thickness")
+    loaded = thicknesses.load_subject(
+      row, source, scale_row, cache=options["cache"], annotations=options["annotations"])
+    name = loaded["name"]
+    state = {
+      "name": name, "cb_mid": loaded["cb_mid"], "img": loaded["img"],
+      "img_path": thicknesses.image_path(source), "scale_row": scale_row,
+      "roi_margin": options.get("roi_margin"), "cache": options["cache"]}
+
+  results, counts = run_steps(STEPS[stage_name], grid, state)
+  log.info(
+    "%s %s: %d combinations, step evaluations %s", row, name, len(results),
+    ", ".join(f"{step} {count}" for step, count in counts.items()))
+  return [
+    {"Name": name, "Row": row, **combination,
+      **({} if result is None else result["measurements"])}
+    for combination, result in results]
+
+def parse_grid(stage_name, items):
+  '''Grid of parameters of a stage from "name=value1,value2" items. The
+  parameters of the stage missing from the items keep their default value.
+  Raises ValueError for unknown parameters, and for values that fail for
+  all specimens: n_clusters below 3, data_steps not smaller than
+  total_steps'''
+  grid = {p: [default] for p, (s, default) in PARAMETERS.items() if s == stage_name}
+  for item in items:
+    name, _, values = item.partition("=")
+    if name not in grid:
+      raise ValueError(f"{name} is not a parameter of the {stage_name} stage")
+    kind = type(PARAMETERS[name][1])
+    grid[name] = [kind(v) for v in values.split(",")]
+  if stage_name == "gyral" and min(grid["n_clusters"]) < 3:
+    raise ValueError("n_clusters must be at least 3 (sulci, gyri and wall labels)")
+  if stage_name == "thickness" and max(grid["data_steps"]) >= min(grid["total_steps"]):
+    raise ValueError(
+      "data_steps must be smaller than total_steps for all combinations, got data_steps="
+      f"{max(grid['data_steps'])} and total_steps={min(grid['total_steps'])}")
+  return grid
+
+def run_sweep(
+  stage_name, grid, n_workers=1, annotations=None, cache=None, roi_margin=None, report=None
+):
+  '''Measure all specimens with a scale for all combinations of a grid
+  Returns
+  -------
+  pandas.DataFrame
+    one row per specimen and combination: name and row of the specimen,
+    parameters and measurements (NaN where they failed)
+  '''
+  data, scale = load_dataset()
+  options = {"annotations": annotations, "cache": cache, "roi_margin": roi_margin}
+  tasks = [
+    (stage_name, row, data.iloc[row]["URL"], scale[row], grid, options)
+    for row in range(len(data)) if scale[row] != 0]
+  results, _ = map_specimens(
+    sweep_specimen, tasks, n_workers, labels=[task[1] for task in tasks], report=report)
+  return pd.DataFrame([r for rows in results if rows is not None for r in rows])
+
+def main(argv=None):
+  '''Command line interface'''
+  parser = add_workers_argument(argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter))
+  parser.add_argument("stage", choices=list(STEPS))
+  parser.add_argument(
+    "--grid", nargs="*", default=[], metavar="NAME=V1,V2",
+    help="values of each parameter")
+  parser.add_argument(
+    "--output", default=None,
+    help="csv file of the results (default: data/derived/sweeps/STAGE.csv)")
+  parser.add_argument(
+    "--roi-margin", type=int, default=None,
+    help="thickness: crop images to the cerebellum contour plus this margin (px)")
+  add_annotations_argument(parser)
+  add_cache_arguments(parser)
+  add_report_arguments(parser)
+  args = parser.parse_args(argv)
+  try:
+    grid = parse_grid(args.stage, args.grid)
+  except ValueError as err:
+    parser.error(str(err))
+  run_report = start_run(args, "parameter_sweep")
+  table = run_sweep(
+    args.stage, grid, args.workers, args.annotations, open_cache(args), args.roi_margin,
+    run_report)
+  atomic_write(
+    args.output or derived_path("sweeps", args.stage + ".csv"),
+    lambda file: table.to_csv(file, index=False))
+  if run_report is not None:
+    run_report.close()
+
+if __name__ == "__main__":
+  main()
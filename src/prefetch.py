@@ -0,0 +1,74 @@
+'''Load the next specimens in background threads while the current one is
+processed'''
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+def loaded_nbytes(value):
+  '''Approximate memory used by a loaded value: the size of the numpy
+  arrays it contains, directly or in a dict, list or tuple'''
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if isinstance(value, dict):
+    return sum(loaded_nbytes(v) for v in value.values())
+  if isinstance(value, (list, tuple)):
+    return sum(loaded_nbytes(v) for v in value)
+  return 0
+
+def prefetched(load, tasks, depth=2, max_bytes=None, n_threads=2):
+  '''Apply load to each task in background threads, ahead of the consumer
+  Parameters
+  ----------
+  load : callable
+    function reading the data of a specimen, called as load(*args)
+  tasks : list of tuple
+    arguments for each call to load
+  depth : int
+    maximum number of tasks loaded ahead of the one being consumed
+  max_bytes : int
+    if provided, no more tasks are loaded ahead while the loaded data
+    waiting to be consumed uses more than max_bytes (see loaded_nbytes),
+    loads in progress counting as the largest data loaded so far. The
+    next task is always loaded
+  n_threads : int
+    number of loading threads
+  Yields
+  ------
+  args : tuple
+    arguments of the task
+  loaded : object
+    result of load(*args), None if it failed
+  error : Exception
+    exception raised by load, None if it succeeded
+  '''
+  tasks = list(tasks)
+  pending = deque()
+  next_task = 0
+  # largest loaded data seen so far, used as the size of the loads in progress
+  largest = 0
+
+  def waiting_bytes():
+    total = 0
+    for _, future in pending:
+      if not future.done():
+        total += largest
+      elif future.exception() is None:
+        total += loaded_nbytes(future.result())
+    return total
+
+  with ThreadPoolExecutor(max_workers=max(n_threads, 1)) as pool:
+    while pending or next_task < len(tasks):
+      while next_task < len(tasks) and (
+        not pending or (
+          len(pending) <= depth
+          and (max_bytes is None or waiting_bytes() < max_bytes))):
+        pending.append((tasks[next_task], pool.submit(load, *tasks[next_task])))
+        next_task += 1
+      args, future = pending.popleft()
+      try:
+        loaded, error = future.result(), None
+        largest = max(largest, loaded_nbytes(loaded))
+      except Exception as err: # pylint: disable=broad-except
+        loaded, error = None, err
+      yield args, loaded, error
@@ -0,0 +1,96 @@
+'''Rasterize shapely polygons into a boolean image without Matplotlib'''
+
+import numpy as np
+import shapely
+
+def _ring_crossings(coords, height):
+  '''Rows and x coordinates where the edges of a ring cross the
+  horizontal lines through the pixel centres'''
+  coords = np.asarray(coords, dtype=float)[:, :2]
+  x0, y0 = coords[:-1, 0], coords[:-1, 1]
+  x1, y1 = coords[1:, 0], coords[1:, 1]
+
+  # an edge crosses the rows whose centre y+0.5 is in [min(y0,y1), max(y0,y1))
+  first = np.ceil(np.minimum(y0, y1) - 0.5).astype(int)
+  last = np.ceil(np.maximum(y0, y1) - 0.5).astype(int)
+  first = np.clip(first, 0, height)
+  last = np.clip(last, 0, height)
+  n_rows = np.maximum(last - first, 0)
+
+  edge = np.repeat(np.arange(len(n_rows)), n_rows)
+  offset = np.arange(len(edge)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+  rows = first[edge] + offset
+  x = x0[edge] + (rows + 0.5 - y0[edge])*(x1[edge] - x0[edge])/(y1[edge] - y0[edge])
+  return rows, x
+
+def rasterize_polygons(polygons, shape):
+  '''Fill polygons, holes included, into a boolean image
+  A pixel is inside if its centre is inside the polygons. Pixel (i, j)
+  covers the square [j, j+1] x [i, i+1] in polygon coordinates. Rings are
+  combined with the even-odd rule, so holes and separate polygons are
+  handled in a single scanline pass.
+  Parameters
+  ----------
+  polygons : list of shapely.geometry.Polygon
+    polygons in pixel coordinates
+  shape : tuple of int
+    (height, width) of the image
+  Returns
+  -------
+  inside : np.array
+    boolean image, True inside the polygons
+  '''
+  height, width = shape[:2]
+  toggles = np.zeros((height, width + 1), dtype=np.uint8)
+  for poly in polygons:
+    for ring in [poly.exterior, *poly.interiors]:
+      rows, x = _ring_crossings(ring.coords, height)
+      cols = np.clip(np.ceil(x - 0.5).astype(int), 0, width)
+      np.bitwise_xor.at(toggles, (rows, cols), 1)
+  return np.bitwise_xor.accumulate(toggles, axis=1)[:, :width].astype(bool)
+
+def _near_pixels(p0, p1, shape, half_width):
+  '''Rows and columns of the pixels whose centre is within half_width of
+  the segments from p0 to p1, each at most 1 px long'''
+  radius = int(np.ceil(half_width)) + 2
+  di, dj = [o.ravel() for o in np.mgrid[-radius:radius + 1, -radius:radius + 1]]
+  rows = np.floor(p0[:, 1]).astype(int)[:, np.newaxis] + di
+  cols = np.floor(p0[:, 0]).astype(int)[:, np.newaxis] + dj
+  # projection of the pixel centres on the segments
+  dx, dy = (p1 - p0).T[:, :, np.newaxis]
+  px = cols + 0.5 - p0[:, 0, np.newaxis]
+  py = rows + 0.5 - p0[:, 1, np.newaxis]
+  t = np.clip((px*dx + py*dy)/np.maximum(dx**2 + dy**2, 1e-12), 0, 1)
+  near = (px - t*dx)**2 + (py - t*dy)**2 <= half_width**2
+  near &= (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+  return rows[near], cols[near]
+
+def rasterize_band(polygons, shape, half_width, chunk_size=65536):
+  '''Pixels whose centre is within a distance of the rings of polygons
+  Rings are split into segments at most 1 px long, and the distance to
+  each segment is computed for the pixels of a small window around it.
+  Parameters
+  ----------
+  polygons : list of shapely.geometry.Polygon
+    polygons in pixel coordinates
+  shape : tuple of int
+    (height, width) of the image
+  half_width : float
+    distance to the rings (px)
+  chunk_size : int
+    number of segments processed at once, to bound memory use
+  Returns
+  -------
+  band : np.array
+    boolean image, True within half_width of a ring
+  '''
+  band = np.zeros(shape[:2], dtype=bool)
+  for poly in polygons:
+    for ring in [poly.exterior, *poly.interiors]:
+      coords = shapely.get_coordinates(shapely.segmentize(ring, 1.0))
+      starts, ends = coords[:-1], coords[1:]
+      for k in range(0, len(starts), chunk_size):
+        rows, cols = _near_pixels(
+          starts[k:k + chunk_size], ends[k:k + chunk_size], shape, half_width)
+        band[rows, cols] = True
+  return band
@@ -0,0 +1,76 @@
+'''Write-ahead journal of per-specimen results, to resume interrupted runs
+
+The journal is a JSON-lines file. The first line records the parameters
+of the run, each following line the result of one finished specimen. Lines
+are flushed to disk as soon as they are written, so that at most the
+specimen being written is lost if the process is killed.
+'''
+
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+class ResultJournal:
+  '''Journal of the results of a run
+  Parameters
+  ----------
+  path : str
+    JSON-lines file of the journal
+  '''
+
+  def __init__(self, path):
+    self.path = path
+
+  def load(self, params):
+    '''Results recorded by a previous run with the same parameters
+    Returns
+    -------
+    dict
+      result of each finished specimen, by key. Empty if there is no
+      journal or if it was written with other parameters
+    '''
+    if not os.path.exists(self.path):
+      return {}
+    results = {}
+    with open(self.path, "r", encoding="utf-8") as file:
+      lines = file.read().split("\n")
+    try:
+      header = json.loads(lines[0])
+    except ValueError:
+      return {}
+    if header.get("params") != json.loads(json.dumps(params)):
+      log.warning("journal %s was written with other parameters, ignored", self.path)
+      return {}
+    for line in lines[1:]:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # last line truncated by an interruption
+        continue
+      results[record["key"]] = record["result"]
+    return results
+
+  def start(self, params, results=None):
+    '''Start a new journal, keeping the results of a previous run if
+    provided'''
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    tmp = self.path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as file:
+      file.write(json.dumps({"params": params}) + "\n")
+      for key, result in (results or {}).items():
+        file.write(json.dumps({"key": key, "result": result}) + "\n")
+    os.replace(tmp, self.path)
+
+  def append(self, key, result):
+    '''Record the result of a specimen and flush it to disk'''
+    with open(self.path, "a", encoding="utf-8") as file:
+      file.write(json.dumps({"key": key, "result": result}) + "\n")
+      file.flush()
+      os.fsync(file.fileno())
+
+  def remove(self):
+    '''Remove the journal once the run is complete'''
+    if os.path.exists(self.path):
+      os.remove(self.path)
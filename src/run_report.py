@@ -0,0 +1,269 @@
+'''Logging, and profiling of the processing stages of each specimen
+
+Code processing a specimen marks its stages with
+  with stage("make_mask", pixels=img.size) as info:
+    ...
+    info["profiles"] = n_profiles
+When a specimen is profiled (see profiling), each stage records its wall
+time, CPU time, memory and sizes. On Linux, the peak resident memory is
+reset at the start of each stage and specimen, so that it is the peak of
+the stage or specimen (including the memory used meanwhile by other
+threads, such as prefetching); elsewhere only the peak of the whole
+process since it started is available. Stages profiled in a background
+thread, such as the loading of the next specimens, record the CPU time of
+their thread and no memory peaks. Otherwise stages cost nothing. The
+records of all specimens are written by RunReport as JSON lines, one line
+per stage plus a "total" line per specimen, and summarised in a table of
+the slowest specimens and stages.
+'''
+
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+log = logging.getLogger(__name__)
+
+# records of the stages of the specimen being profiled by each thread
+_profiled = threading.local()
+
+def configure_logging(level="INFO"):
+  '''Send log messages of the given level and above to stderr'''
+  logging.basicConfig(
+    level=level, format="%(levelname)s: %(message)s", stream=sys.stderr, force=True)
+
+def max_rss_mb():
+  '''Peak resident memory of the process since it started (MB), None if
+  unavailable'''
+  if resource is None:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on Linux, bytes on macOS
+  return rss/2**20 if sys.platform == "darwin" else rss/2**10
+
+def reset_peak_rss():
+  '''Reset the peak resident memory of the process to its current value
+  (Linux only). Returns whether it was reset'''
+  try:
+    with open("/proc/self/clear_refs", "w", encoding="ascii") as file:
+      file.write("5")
+    return True
+  except OSError:
+    return False
+
+def peak_rss_mb():
+  '''Peak resident memory of the process since the last reset_peak_rss
+  (MB), None if unavailable'''
+  try:
+    with open("/proc/self/status", "r", encoding="ascii") as file:
+      for line in file:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1])/2**10
+  except OSError:
+    pass
+  return None
+
+def _measure(background=False):
+  return time.perf_counter(), time.thread_time() if background else time.process_time()
+
+def _start(background=False):
+  '''Reset the memory peaks, unless profiling a background thread, and
+  return the start times, whether the peak resident memory was reset and
+  whether profiling a background thread'''
+  if background:
+    return (*_measure(True), False, True)
+  if tracemalloc.is_tracing():
+    tracemalloc.reset_peak()
+  return (*_measure(), reset_peak_rss(), False)
+
+def _record(name, start, info):
+  wall, cpu = _measure(start[3])
+  record = {"stage": name, "wall": wall - start[0], "cpu": cpu - start[1]}
+  # the memory peaks are not reset in background threads
+  if not start[3]:
+    if tracemalloc.is_tracing():
+      record["peak_traced_mb"] = tracemalloc.get_traced_memory()[1]/2**20
+    if start[2]:
+      record["peak_rss_mb"] = peak_rss_mb()
+    else:
+      record["process_max_rss_mb"] = max_rss_mb()
+  record.update(info)
+  return record
+
+@contextmanager
+def stage(name, **sizes):
+  '''Mark a processing stage of a specimen
+  Parameters
+  ----------
+  name : str
+    name of the stage
+  sizes : int
+    sizes of the data processed (vertices, profiles, pixels...). More
+    can be added to the yielded dictionary
+  '''
+  info = dict(sizes)
+  stages = getattr(_profiled, "stages", None)
+  if stages is None:
+    yield info
+    return
+  start = _start(_profiled.background)
+  try:
+    yield info
+  finally:
+    stages.append(_record(name, start, info))
+
+@contextmanager
+def profiling(trace_memory=False, background=False):
+  '''Profile the stages of a specimen
+  Parameters
+  ----------
+  trace_memory : bool
+    also measure the peak memory allocated in each stage with tracemalloc,
+    which slows down processing
+  background : bool
+    profile stages run in a background thread, alongside those profiled
+    in the main thread: the CPU time is that of the thread, and the memory
+    peaks are neither reset nor recorded
+  Yields
+  ------
+  list of dict
+    record of each stage, followed by a "total" record for the specimen
+  '''
+  _profiled.stages = stages = []
+  _profiled.background = background
+  started_tracing = trace_memory and not background and not tracemalloc.is_tracing()
+  if started_tracing:
+    tracemalloc.start()
+  start = _start(background)
+  try:
+    yield stages
+  finally:
+    _profiled.stages = None
+    total = _record("total", start, {})
+    for peak in ("peak_traced_mb", "peak_rss_mb"):
+      if total.get(peak) is not None:
+        # the peaks are reset at each stage
+        total[peak] = max([total[peak]] + [s.get(peak) or 0 for s in stages])
+    stages.append(total)
+    if started_tracing:
+      tracemalloc.stop()
+
+def merge_profiles(*profiles):
+  '''Records of a specimen profiled in several parts, such as its loading
+  in a background thread and its processing, with a single "total" record
+  adding up the times of the parts. Parts that are None are skipped
+  Returns
+  -------
+  list of dict
+    records of the stages of all parts followed by the total, None if all
+    parts are None
+  '''
+  profiles = [p for p in profiles if p is not None]
+  if not profiles:
+    return None
+  totals = [r for p in profiles for r in p if r["stage"] == "total"]
+  total = dict(totals[-1])
+  for key in ("wall", "cpu"):
+    total[key] = sum(t[key] for t in totals)
+  for peak in ("peak_traced_mb", "peak_rss_mb", "process_max_rss_mb"):
+    values = [t[peak] for t in totals if t.get(peak) is not None]
+    if values:
+      total[peak] = max(values)
+  return [r for p in profiles for r in p if r["stage"] != "total"] + [total]
+
+class RunReport:
+  '''JSON-lines report of the stages of each specimen of a run
+  Parameters
+  ----------
+  path : str
+    JSON-lines file, overwritten
+  script : str
+    name of the script, recorded with each line
+  trace_memory : bool
+    measure allocated memory with tracemalloc
+  '''
+
+  def __init__(self, path, script, trace_memory=False):
+    self.path = path
+    self.script = script
+    self.trace_memory = trace_memory
+    self.records = []
+    self.file = open(path, "w", encoding="utf-8") # pylint: disable=consider-using-with
+
+  def add(self, label, stages, error=None):
+    '''Record the stages of a specimen'''
+    for record in stages or []:
+      record = {"script": self.script, "specimen": label, **record}
+      if record["stage"] == "total":
+        record["error"] = error is not None
+      self.records.append(record)
+      self.file.write(json.dumps(record, default=str) + "\n")
+    self.file.flush()
+
+  def summary(self, top=10):
+    '''Table of the slowest specimens and of the time spent in each stage'''
+    totals = sorted(
+      (r for r in self.records if r["stage"] == "total"),
+      key=lambda r: r["wall"], reverse=True)
+    # peak of each specimen if available, otherwise of the process so far
+    rss = "peak_rss_mb" if any("peak_rss_mb" in r for r in totals) else "process_max_rss_mb"
+    lines = [f"Slowest specimens ({self.script})",
+      f"{'specimen':<40} {'wall (s)':>9} {'cpu (s)':>9} "
+      + ("peak rss (MB)" if rss == "peak_rss_mb" else "process max rss (MB)")]
+    for r in totals[:top]:
+      lines.append(
+        f"{str(r['specimen'])[:40]:<40} {r['wall']:9.2f} {r['cpu']:9.2f} "
+        f"{r.get(rss) or 0:13.0f}")
+
+    stages = {}
+    for r in self.records:
+      if r["stage"] != "total":
+        s = stages.setdefault(r["stage"], {"count": 0, "wall": 0, "cpu": 0, "max": 0})
+        s["count"] += 1
+        s["wall"] += r["wall"]
+        s["cpu"] += r["cpu"]
+        s["max"] = max(s["max"], r["wall"])
+    lines.append("Stages")
+    lines.append(
+      f"{'stage':<40} {'count':>9} {'wall (s)':>9} {'cpu (s)':>9} {'max (s)':>9}")
+    for name, s in sorted(stages.items(), key=lambda x: x[1]["wall"], reverse=True):
+      lines.append(
+        f"{name:<40} {s['count']:9d} {s['wall']:9.2f} {s['cpu']:9.2f} {s['max']:9.2f}")
+    return "\n".join(lines)
+
+  def close(self):
+    '''Close the report and log its summary'''
+    self.file.close()
+    log.info("report saved to %s\n%s", self.path, self.summary())
+
+def add_report_arguments(parser):
+  '''Add the --log-level, --report and --trace-memory options to an
+  argparse parser'''
+  parser.add_argument(
+    "--log-level", default="INFO",
+    choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    help="minimum level of the messages shown (default: INFO)")
+  parser.add_argument(
+    "--report", default=None,
+    help="profile the stages of each specimen and save a JSON-lines report "
+    "to this file")
+  parser.add_argument(
+    "--trace-memory", action="store_true",
+    help="with --report, also measure allocated memory with tracemalloc (slower)")
+  return parser
+
+def start_run(args, script):
+  '''Configure logging from the parsed arguments, and return a RunReport
+  if a report was requested, otherwise None'''
+  configure_logging(args.log_level)
+  if args.report is None:
+    return None
+  return RunReport(args.report, script, args.trace_memory)
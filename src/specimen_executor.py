@@ -0,0 +1,170 @@
+'''Run a per-specimen function over many specimens using a process pool'''
+
+import functools
+import logging
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dataset
+from prefetch import prefetched
+from run_report import configure_logging, profiling, merge_profiles
+
+log = logging.getLogger(__name__)
+
+def default_workers():
+  '''Default number of worker processes: one per available core'''
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+def _error_message(err):
+  '''Type, message and traceback of an exception'''
+  return "%s: %s\n%s"%(
+    type(err).__name__, err, "".join(traceback.format_exception(err)))
+
+def _init_worker(level, data_dir):
+  '''Configure a worker process like the current one: logging level and
+  data directory. Workers that are spawned rather than forked import the
+  modules again, with their default settings'''
+  configure_logging(level)
+  dataset.set_data_dir(data_dir)
+
+def _load_and_call(func, load, *args):
+  '''Call func(*args, load(*args))'''
+  return func(*args, load(*args))
+
+def _prefetch_call(load, profile, *args):
+  '''Call load(*args) in a prefetch thread, as _call does, profiling its
+  stages as those of a background thread'''
+  if profile is not None:
+    profile = {**profile, "background": True}
+  return _call(load, args, profile)
+
+def _call(func, args, profile=None):
+  '''Call func(*args), returning (result, None, stages) on success
+  or (None, error message, stages) on failure. If profile is a dict of
+  options for run_report.profiling, stages are the records of the
+  profiled stages, otherwise None'''
+  stages = None
+  try:
+    if profile is None:
+      return func(*args), None, None
+    with profiling(**profile) as stages:
+      result = func(*args)
+    return result, None, stages
+  except Exception as err: # pylint: disable=broad-except
+    return None, _error_message(err), stages
+
+def map_specimens(
+  func, tasks, n_workers=1, labels=None, on_result=None, report=None,
+  load=None, prefetch=2, prefetch_bytes=None
+):
+  '''Apply a function to each specimen, possibly in parallel
+  Parameters
+  ----------
+  func : callable
+    top-level (picklable) function processing one specimen
+  tasks : list of tuple
+    arguments for each call to func
+  n_workers : int
+    number of worker processes. With 1, tasks are run serially in
+    the current process
+  labels : list
+    label for each task, used when reporting errors. Defaults to
+    the position of the task in the list
+  on_result : callable
+    if provided, called in the current process as on_result(index, result)
+    as soon as each task succeeds, in order of completion
+  report : run_report.RunReport
+    if provided, the stages of each task are profiled and added to
+    this report
+  load : callable
+    if provided, top-level function reading the data of a specimen
+    (files, images), called as load(*args). func is then called as
+    func(*args, load(*args)). When running serially, the data of the
+    next tasks are loaded in background threads while the current task
+    is processed, and the stages of load are profiled in these threads
+  prefetch : int
+    number of tasks loaded ahead when running serially
+  prefetch_bytes : int
+    if provided, stop loading ahead while the data waiting to be
+    processed use more memory than this
+  Returns
+  -------
+  results : list
+    result of each call in the order of tasks, None where the call failed
+  errors : list of tuple
+    (label, error message) for each failed call, in the order of tasks
+  '''
+  tasks = list(tasks)
+  if labels is None:
+    labels = list(range(len(tasks)))
+  if n_workers is None or n_workers < 1:
+    n_workers = default_workers()
+  n_workers = min(n_workers, max(len(tasks), 1))
+
+  profile = None
+  if report is not None:
+    profile = {"trace_memory": report.trace_memory}
+
+  outputs = [None]*len(tasks)
+  def finish(index, output):
+    # report each error or result as soon as it arrives
+    result, err, stages = output
+    if report is not None:
+      report.add(labels[index], stages, err)
+    if err is not None:
+      log.error("%s %s", labels[index], err)
+    elif on_result is not None:
+      on_result(index, result)
+    outputs[index] = (result, err)
+
+  if n_workers == 1 and load is not None:
+    loads = prefetched(
+      functools.partial(_prefetch_call, load, profile), tasks, prefetch, prefetch_bytes)
+    for index, (args, (loaded, err, load_stages), _) in enumerate(loads):
+      result, stages = None, None
+      if err is None:
+        result, err, stages = _call(func, (*args, loaded), profile)
+      # records of the loading and processing of the specimen
+      finish(index, (result, err, merge_profiles(load_stages, stages)))
+  elif n_workers == 1:
+    for index, args in enumerate(tasks):
+      finish(index, _call(func, args, profile))
+  else:
+    if load is not None:
+      # each worker loads the data of its tasks
+      func = functools.partial(_load_and_call, func, load)
+    with ProcessPoolExecutor(
+      max_workers=n_workers, initializer=_init_worker,
+      initargs=(logging.getLogger().getEffectiveLevel(), dataset.data_dir())
+    ) as pool:
+      futures = {
+        pool.submit(_call, func, args, profile): index
+        for index, args in enumerate(tasks)}
+      for future in as_completed(futures):
+        finish(futures[future], future.result())
+
+  results = [result for result, _ in outputs]
+  errors = [
+    (label, err) for label, (_, err) in zip(labels, outputs) if err is not None]
+  return results, errors
+
+def add_prefetch_arguments(parser):
+  '''Add the --prefetch and --prefetch-memory options to an argparse parser'''
+  parser.add_argument(
+    "--prefetch", type=int, default=2,
+    help="when running serially, number of specimens read ahead in "
+    "background threads (default: 2)")
+  parser.add_argument(
+    "--prefetch-memory", type=float, default=2,
+    help="maximum memory of the specimens read ahead, in GB (default: 2)")
+  return parser
+
+def add_workers_argument(parser):
+  '''Add the --workers option to an argparse parser'''
+  parser.add_argument(
+    "-j", "--workers", type=int, default=default_workers(),
+    help="number of worker processes (default: number of cores)")
+  return parser
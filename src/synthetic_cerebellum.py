@@ -0,0 +1,368 @@
+'''Synthetic folded cerebellum contours and slides with known measurements
+
+A synthetic section is a closed contour whose radius is modulated by
+large lobules and by regular folia, plus optional small islands. Sulci
+are at the deepest points of the folia, so that the gyral period and
+width of each fold are known. The matching slide is rendered with a
+molecular layer of known thickness along the contour, followed by the
+granular layer and the white matter.
+
+Coordinates are in mm. A slide of width_px pixels covers
+[0, width_px/px_per_mm] in x and y, and the scale used by
+thickness.compute_thickness is width_px/(1000*px_per_mm).
+
+Usage:
+  python synthetic_cerebellum.py generate OUTPUT_DIR [--width-px 2000] ...
+  python synthetic_cerebellum.py stress [--vertices 1e3 1e4 1e5 1e6]
+    [--width-px 2000 3000 4000] [--report FILE]
+stress times each stage of the gyri and thickness pipelines over the
+requested sizes, fits their complexity (exponent of the time as a power
+of the size) and checks the number of folds detected and the measured
+period, width and thickness against the ground truth. In the vertices
+sweep, the contour is resampled to the requested number of vertices, and
+scaled so that each fold keeps about the same number of vertices.
+'''
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+from scipy import ndimage
+from shapely.geometry import Polygon, MultiPolygon
+from skimage import io
+import thickness as th
+from rasterize_polygons import rasterize_polygons
+from run_report import configure_logging, profiling, RunReport
+
+# grey levels of the rendered slide
+BACKGROUND = 1.0
+MOLECULAR = 0.8
+GRANULAR = 0.25
+WHITE_MATTER = 0.6
+
+def contour_points(theta, radius, n_folia, fold_depth, n_lobules, lobule_depth, sharpness, center):
+  '''Points of the folded contour at angles theta'''
+  base = radius*(1 + lobule_depth*np.cos(n_lobules*theta))
+  depth = fold_depth*((1 + np.cos(n_folia*theta))/2)**sharpness
+  r = base - depth
+  return np.stack([center[0] + r*np.cos(theta), center[1] + r*np.sin(theta)], axis=1)
+
+def folded_contour(
+  n_vertices=4000, radius=4.0, n_folia=40, fold_depth=0.6, n_lobules=5,
+  lobule_depth=0.1, sharpness=2.0, n_islands=0, center=(5.0, 5.0)
+):
+  '''Synthetic cerebellum contour with known folds
+  Parameters
+  ----------
+  n_vertices : int
+    number of vertices of the main polygon
+  radius : float
+    mean radius (mm)
+  n_folia : int
+    number of folds
+  fold_depth : float
+    depth of the sulci (mm)
+  n_lobules : int
+    number of lobules, modulating the radius at a larger scale
+  lobule_depth : float
+    relative amplitude of the lobules
+  sharpness : float
+    exponent of the fold profile; larger values give narrower sulci
+  n_islands : int
+    number of small separate polygons around the main one, with fewer
+    vertices
+  center : tuple
+    center of the contour (mm)
+  Returns
+  -------
+  contour : shapely.geometry.MultiPolygon
+    main polygon followed by the islands
+  truth : dict
+    period and width (mm) of each fold, from one sulcus to the next
+  '''
+  params = (radius, n_folia, fold_depth, n_lobules, lobule_depth, sharpness, center)
+  theta = 2*np.pi*np.arange(n_vertices)/n_vertices
+  polygons = [Polygon(contour_points(theta, *params))]
+
+  for i in range(n_islands):
+    angle = 2*np.pi*(i + 0.5)/n_islands
+    island_center = np.array(center) + 1.25*radius*np.array([np.cos(angle), np.sin(angle)])
+    island_theta = 2*np.pi*np.arange(max(n_vertices//20, 16))/max(n_vertices//20, 16)
+    polygons.append(Polygon(
+      island_center + 0.1*radius*np.stack([np.cos(island_theta), np.sin(island_theta)], axis=1)))
+
+  # ground truth from a dense sampling of each fold, between the sulci at
+  # angles 2*pi*k/n_folia
+  samples = 256
+  sulci = 2*np.pi*np.arange(n_folia + 1)/n_folia
+  dense = contour_points(
+    np.linspace(0, 2*np.pi, n_folia*samples + 1), *params).reshape(-1, 2)
+  segment = np.linalg.norm(np.diff(dense, axis=0), axis=1).reshape(n_folia, samples)
+  sulci_points = contour_points(sulci, *params)
+  truth = {
+    "period": segment.sum(axis=1),
+    "width": np.linalg.norm(np.diff(sulci_points, axis=0), axis=1)
+  }
+  return MultiPolygon(polygons), truth
+
+def layer_distances(inside, max_distance, band_rows=1024):
+  '''Distance (px) of the pixels inside a mask to the nearest pixel
+  outside, clipped to max_distance. The distance transform is computed by
+  bands of rows with a halo of max_distance rows, which is exact up to
+  max_distance and bounds the memory used'''
+  halo = int(np.ceil(max_distance)) + 1
+  distance = np.empty(inside.shape, dtype=np.float32)
+  for start in range(0, inside.shape[0], band_rows):
+    stop = min(start + band_rows, inside.shape[0])
+    lo, hi = max(start - halo, 0), min(stop + halo, inside.shape[0])
+    band = ndimage.distance_transform_edt(inside[lo:hi])
+    distance[start:stop] = np.minimum(band[start - lo:stop - lo], max_distance)
+  return distance
+
+def render_slide(
+  contour, width_px, px_per_mm=100, thickness=0.08, granular=0.15,
+  blur=1.0, noise=0.02, seed=0
+):
+  '''Render a grey-level slide of a synthetic contour
+  Parameters
+  ----------
+  contour : shapely.geometry.MultiPolygon
+    contour (mm)
+  width_px : int
+    width and height of the slide (px)
+  px_per_mm : float
+    resolution of the slide
+  thickness : float
+    thickness of the molecular layer (mm)
+  granular : float
+    thickness of the granular layer (mm)
+  blur : float
+    standard deviation of the Gaussian blur (px)
+  noise : float
+    standard deviation of the Gaussian noise
+  seed : int
+    seed of the noise
+  Returns
+  -------
+  np.array
+    uint8 image of shape (width_px, width_px)
+  '''
+  scaled = [
+    Polygon(np.asarray(p.exterior.coords)*px_per_mm) for p in contour.geoms]
+  inside = rasterize_polygons(scaled, (width_px, width_px))
+  t_px = thickness*px_per_mm
+  g_px = granular*px_per_mm
+  distance = layer_distances(inside, t_px + g_px + 1)
+
+  img = np.full(inside.shape, BACKGROUND, dtype=np.float32)
+  img[inside] = WHITE_MATTER
+  img[inside & (distance <= t_px + g_px)] = GRANULAR
+  img[inside & (distance <= t_px)] = MOLECULAR
+  if blur > 0:
+    img = ndimage.gaussian_filter(img, blur)
+  if noise > 0:
+    img += np.random.default_rng(seed).normal(0, noise, img.shape).astype(np.float32)
+  return (np.clip(img, 0, 1)*255).astype(np.uint8)
+
+def width_for_folia(n_folia, px_per_mm=100, fold_spacing=0.8):
+  '''Slide width (px) of the synthetic_specimen with n_folia folia'''
+  return int(np.ceil(n_folia*fold_spacing/(2*np.pi*0.35)*px_per_mm*(1 + 1e-9)))
+
+def synthetic_specimen(
+  width_px=2000, px_per_mm=100, n_vertices=None, fold_spacing=0.8,
+  fold_depth=0.6, n_lobules=5, n_islands=2, thickness=0.08, seed=0
+):
+  '''Contour, slide parameters and ground truth of a synthetic specimen
+  whose cerebellum fills the slide. The number of folia grows with the
+  size, so that folds are fold_spacing mm apart.
+  Returns
+  -------
+  contour : shapely.geometry.MultiPolygon
+    contour (mm)
+  truth : dict
+    period and width of each fold, thickness of the molecular layer,
+    scale of the slide, and parameters
+  '''
+  size = width_px/px_per_mm
+  radius = 0.35*size
+  n_folia = max(int(2*np.pi*radius/fold_spacing), 3)
+  if n_vertices is None:
+    n_vertices = 32*n_folia
+  contour, truth = folded_contour(
+    n_vertices=n_vertices, radius=radius, n_folia=n_folia, fold_depth=fold_depth,
+    n_lobules=n_lobules, n_islands=n_islands, center=(size/2, size/2))
+  truth.update({
+    "thickness": thickness,
+    "scale": width_px/(1000*px_per_mm),
+    "width_px": width_px,
+    "px_per_mm": px_per_mm,
+    "n_vertices": n_vertices,
+    "n_folia": n_folia,
+    "seed": seed
+  })
+  return contour, truth
+
+def save_specimen(contour, truth, output_dir, name="synthetic", render=True):
+  '''Save a synthetic specimen as a MicroDraw-like JSON annotation, a png
+  slide and a JSON file with the ground truth'''
+  os.makedirs(output_dir, exist_ok=True)
+  annotation = {
+    "name": name,
+    "scale": truth["scale"],
+    "slice_polygons": [
+      [[np.asarray(p.exterior.coords).tolist()]] for p in contour.geoms]
+  }
+  with open(os.path.join(output_dir, name + ".cb.json"), "w", encoding="utf-8") as file:
+    json.dump(annotation, file)
+  with open(os.path.join(output_dir, name + ".truth.json"), "w", encoding="utf-8") as file:
+    json.dump({k: np.asarray(v).tolist() for k, v in truth.items()}, file)
+  if render:
+    img = render_slide(
+      contour, truth["width_px"], truth["px_per_mm"], truth["thickness"], seed=truth["seed"])
+    io.imsave(os.path.join(output_dir, name + ".cb.png"), img, check_contrast=False)
+
+def relative_error(measured, expected):
+  '''Relative error of a measurement'''
+  return float(abs(measured - expected)/expected)
+
+def measure_specimen(contour, truth, img_path=None, n_points=None):
+  '''Run the gyri pipeline (and the thickness pipeline if an image is
+  provided) on a synthetic specimen
+  Parameters
+  ----------
+  n_points : int
+    number of vertices the contour is resampled to by the gyri pipeline,
+    by default scaled with its length
+  Returns
+  -------
+  dict
+    measured medians of the period, width and thickness, and their
+    relative error to the ground truth
+  '''
+  gyral = importlib.import_module("2_figure3_folial_width_perimeter")
+  period, width = gyral.measure_folds(contour, n_points=n_points)
+  # remove the 0 marking the end of the contour
+  result = {
+    "period": float(np.median(period[:-1])) if len(period) > 1 else float("nan"),
+    "width": float(np.median(width[:-1])) if len(width) > 1 else float("nan"),
+    "folds": len(period) - 1
+  }
+  result["period_error"] = relative_error(result["period"], np.median(truth["period"]))
+  result["width_error"] = relative_error(result["width"], np.median(truth["width"]))
+  if img_path is not None:
+    csv = th.compute_thickness(truth["scale"], contour, "synthetic", img_path)
+    result["thickness"] = float(csv.split(",")[1]) if csv else float("nan")
+    result["thickness_error"] = relative_error(result["thickness"], truth["thickness"])
+  return result
+
+def complexity(sizes, times):
+  '''Exponent of the best power law fit time ~ size**exponent'''
+  sizes, times = np.asarray(sizes, dtype=float), np.asarray(times, dtype=float)
+  if len(sizes) < 2 or np.any(times <= 0):
+    return float("nan")
+  return float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+
+def stress(vertices, widths_px, report=None, tolerance=0.15, vertices_per_fold=100):
+  '''Time the pipelines over increasing sizes and check the measurements
+  Parameters
+  ----------
+  vertices : list of int
+    numbers of vertices of the resampled contour in the gyri sweep (no
+    slide). The contour has vertices/vertices_per_fold folia, and at
+    least 50 (slides of at least 1819 px)
+  widths_px : list of int
+    slide widths of the thickness sweep, with a contour filling the slide
+  report : run_report.RunReport
+    if provided, the records of each run are added to it
+  tolerance : float
+    maximum relative error of the median measurements
+  vertices_per_fold : int
+    number of vertices of each fold in the gyri sweep
+  Returns
+  -------
+  bool
+    True if all measurements are within tolerance and the number of
+    folds detected is right
+  '''
+  ok = True
+  curves = {}
+  runs = [
+    ("vertices", n, {"width_px": width_for_folia(max(n/vertices_per_fold, 50))}, int(n))
+    for n in vertices]
+  runs += [("width_px", w, {"width_px": int(w)}, None) for w in widths_px]
+  with tempfile.TemporaryDirectory() as tmp:
+    # warm up imports and caches, so that the first run is not slower
+    measure_specimen(*synthetic_specimen(width_px=500))
+    for sweep, size, params, n_points in runs:
+      contour, truth = synthetic_specimen(**params)
+      img_path = None
+      if sweep == "width_px":
+        save_specimen(contour, truth, tmp, render=True)
+        img_path = os.path.join(tmp, "synthetic.cb.png")
+      with profiling() as stages:
+        result = measure_specimen(contour, truth, img_path, n_points)
+      label = f"{sweep}={size}"
+      if report is not None:
+        report.add(label, stages)
+      errors = {k: v for k, v in result.items() if k.endswith("_error")}
+      # the fold containing the start of the contour is usually split in two
+      # and not counted
+      passed = (
+        all(e <= tolerance for e in errors.values())
+        and truth["n_folia"] - 1 <= result["folds"] <= truth["n_folia"])
+      ok = ok and passed
+      print(f"{label:<20} {stages[-1]['wall']:8.2f}s  folds {result['folds']}/{truth['n_folia']}  "
+        + "  ".join(f"{k} {v:.1%}" for k, v in errors.items())
+        + ("" if passed else "  FAILED"), flush=True)
+      for record in stages:
+        curves.setdefault((sweep, record["stage"]), []).append((size, record["wall"]))
+
+  print(f"{'sweep':<10} {'stage':<25} exponent")
+  for (sweep, name), points in sorted(curves.items()):
+    sizes, times = zip(*points)
+    print(f"{sweep:<10} {name:<25} {complexity(sizes, times):8.2f}")
+  return ok
+
+def main(argv=None):
+  '''Command line interface'''
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  generate_parser = subparsers.add_parser("generate", help="save a synthetic specimen")
+  generate_parser.add_argument("output_dir")
+  generate_parser.add_argument("--width-px", type=int, default=2000)
+  generate_parser.add_argument("--px-per-mm", type=float, default=100)
+  generate_parser.add_argument("--vertices", type=int, default=None)
+  generate_parser.add_argument("--n-islands", type=int, default=2)
+  generate_parser.add_argument("--thickness", type=float, default=0.08)
+  generate_parser.add_argument("--name", default="synthetic")
+  stress_parser = subparsers.add_parser("stress", help="time and check the pipelines")
+  stress_parser.add_argument(
+    "--vertices", type=float, nargs="*", default=[1e3, 1e4, 1e5])
+  stress_parser.add_argument(
+    "--width-px", type=int, nargs="*", default=[2000, 3000, 4000])
+  stress_parser.add_argument("--tolerance", type=float, default=0.15)
+  stress_parser.add_argument("--report", default=None, help="JSON-lines report")
+  args = parser.parse_args(argv)
+  configure_logging("WARNING")
+
+  if args.command == "generate":
+    contour, truth = synthetic_specimen(
+      args.width_px, args.px_per_mm, args.vertices, n_islands=args.n_islands,
+      thickness=args.thickness)
+    save_specimen(contour, truth, args.output_dir, args.name)
+    return 0
+
+  report = None
+  if args.report is not None:
+    report = RunReport(args.report, "synthetic_cerebellum")
+  ok = stress([int(n) for n in args.vertices], args.width_px, report, args.tolerance)
+  if report is not None:
+    report.close()
+  return 0 if ok else 1
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -2,233 +2,364 @@
 Compute the thickness of the molecular layer of the cerebellum
 '''
 
+import logging
 import os
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 import shapely
-import skimage
-from scipy.interpolate import interp2d
-from scipy.signal import find_peaks
+from scipy import ndimage
 from shapely import affinity
-from shapely.geometry import LinearRing, LineString
-from skimage import exposure
-from skimage import io, filters
-from skimage.measure import subdivide_polygon
-from shapely_polygon_to_matplotlib_patch import polygon_patch
-
-def mid_vector(v1, v2):
-  '''compute the angle and the vector between two vectors'''
-  v1 = v1/np.linalg.norm(v1)
-  v2 = v2/np.linalg.norm(v2)
-  v1t = np.array([-v1[1], v1[0]])
-  x = v2.dot(v1)
-  y = v2.dot(v1t)
-  ang12 = np.arctan2(y, x)
-  r = v1*np.cos(ang12/2) + v1t*np.sin(ang12/2)
-  return ang12, r
-
-def polygon_normals(poly, profile_length = 5):
-  '''compute normal vectors for each point in the polygon'''
-  normals = np.zeros(poly.shape)
-  for i, b in enumerate(poly):
-    a = poly[(i-1+len(poly))%len(poly)]
-    c = poly[(i+1)%len(poly)]
-    x1 = a[1] - b[1]
-    y1 = -(a[0] - b[0])
-    x2 = -(c[1] - b[1])
-    y2 = (c[0] - b[0])
-    _, normal = mid_vector(np.array([x1, y1]), np.array([x2, y2]))
-    x, y = profile_length * normal
-    normals[i] = [b[0] - x, b[1] - y]
-  return normals
-
-def polygon_resample(poly, normals, profile_length=5, max_ang = np.pi/6):
-  '''improve sampling by comparing the angle between consecutive normal vectors'''
-
-  where = []
-  what_start = []
-  what_end = []
-  for i, _ in enumerate(poly):
-    prev = (i - 1 + len(poly))%len(poly)
-    ang, new_normal = mid_vector(normals[prev]-poly[prev], normals[i]-poly[i])
-    if np.abs(ang) > max_ang:
-      new_poly_point = (poly[i] + poly[prev])/2
-      where.append(i)
-      what_start.append(new_poly_point)
-      what_end.append(new_poly_point + profile_length * new_normal)
-  if where:
-    return (
-      np.insert(poly, where, what_start, axis=0),
-      np.insert(normals, where, what_end, axis=0)
-    )
-  return poly, normals
-
-def load_image(img_path):
-  '''Load image and apply preprocessing'''
-  img = io.imread(img_path)
+from rasterize_polygons import rasterize_polygons, rasterize_band
+import contour_resampling as cr
+from image_cache import cache_key, file_hash
+from contour_artifacts import ContourArtifacts
+from run_report import stage
+
+log = logging.getLogger(__name__)
+
+def read_image(img_path):
+  '''Read an image file'''
+  # imported here to keep the import of the module fast
+  from skimage import io # pylint: disable=import-outside-toplevel
+  return io.imread(img_path)
+
+def preprocess_image(img, kernel_size=None):
+  '''Convert to grey levels, denoise and equalise an image
+  kernel_size is passed to equalize_adapthist, and defaults to 1/8 of
+  the image dimensions'''
+  from skimage import color, exposure, filters, morphology # pylint: disable=import-outside-toplevel
   if len(img.shape) == 2:
     img_gray = img
   else:
-    img_gray = skimage.color.rgb2gray(img)
+    img_gray = color.rgb2gray(img)
   img_gray = img_gray/np.max(img_gray)
-  img = filters.median(img_gray, skimage.morphology.disk(1))
-  img = exposure.equalize_adapthist(img)
+  img = filters.median(img_gray, morphology.disk(1))
+  img = exposure.equalize_adapthist(img, kernel_size=kernel_size)
   return img
 
-def scale_contour_to_image(img, sub_scale, sub_cb_mid):
-  '''Scale the contour to the image size'''
-  g = (img.shape[1]/1000)/sub_scale
+def load_image(img_path):
+  '''Load image and apply preprocessing'''
+  return preprocess_image(read_image(img_path))
+
+def contour_roi(shape, scaled_mpoly, margin):
+  '''Region of interest containing the contour plus a margin
+  Parameters
+  ----------
+  shape : tuple of int
+    shape of the image
+  scaled_mpoly : shapely.geometry.MultiPolygon
+    contour in image coordinates
+  margin : int
+    margin around the bounding box of the contour, in px
+  Returns
+  -------
+  roi : tuple of slice
+    rows and columns of the region of interest
+  '''
+  minx, miny, maxx, maxy = scaled_mpoly.bounds
+  return (
+    slice(max(int(np.floor(miny)) - margin, 0), min(int(np.ceil(maxy)) + margin, shape[0])),
+    slice(max(int(np.floor(minx)) - margin, 0), min(int(np.ceil(maxx)) + margin, shape[1]))
+  )
+
+def scale_contour_to_image(img_width, sub_scale, sub_cb_mid):
+  '''Scale the contour to the image size, given the image width in px'''
+  g = (img_width/1000)/sub_scale
   return affinity.scale(sub_cb_mid, xfact=g, yfact=g, origin=(0,0))
 
-def resample_contour(sm, img, min_length):
-  '''Resample the contour to a given minimum length between vertices'''
-  p = np.array(sm.exterior.coords)
-  p2 = subdivide_polygon(p, degree=3)
-  ring = LinearRing(p2)
-  ring_length = ring.length * (1000/img.shape[1])
-  n_points = int(np.ceil(ring_length/min_length))
-  pp = np.zeros((n_points, 2))
-  for i in range(n_points):
-    pp[i, :] = np.array(*ring.interpolate(i/n_points, normalized=True).coords)
+def resample_contour(sm, img_width, min_length):
+  '''Resample the contour to a given minimum length between vertices,
+  in svg dimensions (1000 px for the width of the image)'''
+  pp, _ = cr.resample_polygon(
+    np.array(sm.exterior.coords), min_length, length_scale=1000/img_width)
   return pp
 
-def make_mask(img, scaled_mpoly):
-  '''Make a mask from the contour'''
-  fig = plt.figure(figsize=(img.shape[1],img.shape[0]), dpi=1)
-  ax = fig.add_subplot()
-  plt.subplots_adjust(top = 1, bottom = 0, right = 1, left = 0, hspace = 0, wspace = 0)
-  ax.set_axis_off()
-  ax.set_xlim(0, img.shape[1])
-  ax.set_ylim(img.shape[0], 0)
-
-  for sm in scaled_mpoly:
-    patch = polygon_patch(sm, alpha=1, ec="r", fc="k", lw=2)
-    ax.add_patch(patch)
-    patch = polygon_patch(sm, alpha=1, ec="w", fill=False, lw=200)
-    ax.add_patch(patch)
-
-  fig.canvas.draw()
-  fig.canvas.figure.set_facecolor("white")
-  mask = fig.canvas.buffer_rgba()
-  mask = np.array(mask)
-  plt.close()
-  mask = np.invert(mask)[:,:,0]
+def make_mask(img, scaled_mpoly, band=0.85):
+  '''Make a mask from the contour
+  Pixels inside the contour are set to 255, except for a band along the
+  contour: pixels whose centre is within band px of the contour are set
+  to 0, like the rest of the image.
+  The previous Matplotlib mask drew a 200 pt line (200/72 px at 1 dpi)
+  along the contour, antialiased, and every pixel it did not cover
+  entirely was kept in the mask. The default band reproduces it: the
+  mask starts 0.8 to 0.9 px from the contour depending on its angle.
+  '''
+  inside = rasterize_polygons(scaled_mpoly, img.shape)
+  inside &= ~rasterize_band(scaled_mpoly, img.shape, band)
+  mask = inside.astype(np.uint8)*255
   return mask
 
-def compute_image_gradients(img, mask, sigma=3, smooth_iterations=10):
-  '''Compute image gradients'''
-  smo = img.copy()
+def compute_image_gradients(img, mask, sigma=3, smooth_iterations=10, passes=None):
+  '''Compute image gradients
+  The image is smoothed by repeatedly setting the pixels outside the mask
+  to 1 (white) and applying a Gaussian filter, so that the smoothed image
+  brightens towards the contour. Pixels further than the filter radius
+  from the mask are always 1, so the smoothing is computed only within
+  the bounding box of the mask plus that radius, with the same result
+  as on the whole image.
+  Parameters
+  ----------
+  img : np.array
+    grey level image
+  mask : np.array
+    mask of the cerebellum, 0 outside
+  sigma : float
+    standard deviation of the Gaussian filter at each iteration
+  smooth_iterations : int
+    number of iterations
+  passes : int
+    if provided, the smoothing is done in this number of passes,
+    each with a Gaussian of standard deviation
+    sigma*sqrt(smooth_iterations/passes), preserving the total amount
+    of smoothing but not the boundary behaviour. With the defaults,
+    5 passes are 1.4x faster and change the smoothed image inside
+    the mask by up to 0.17 (0.1 at the 99th percentile), 1 pass is
+    3x faster and changes it by up to 0.56 (0.39)
+  Returns
+  -------
+  DxW, DyW : np.array
+    gradients of the smoothed image along rows and columns
+  smo : np.array
+    smoothed image
+  '''
+  if passes is not None and passes != smooth_iterations:
+    sigma = sigma*np.sqrt(smooth_iterations/passes)
+    smooth_iterations = passes
+
+  smo = np.ones(img.shape)
+  DxW = np.zeros(img.shape)
+  DyW = np.zeros(img.shape)
+  rows, cols = np.nonzero(mask)
+  if len(rows) == 0:
+    return DxW, DyW, smo
+
+  # region influenced by the mask
+  halo = int(4.0 * sigma + 0.5) + 2
+  roi = (
+    slice(max(rows.min() - halo, 0), rows.max() + halo + 1),
+    slice(max(cols.min() - halo, 0), cols.max() + halo + 1)
+  )
+
+  outside = mask[roi] == 0
+  roi_smo = np.array(img[roi], dtype=float)
+  tmp = np.empty_like(roi_smo)
   for _ in range(smooth_iterations):
-    smo[mask==0] = 1
-    smo = skimage.filters.gaussian(smo, sigma=3)
-  DxW, DyW = np.gradient(smo, 1)
+    roi_smo[outside] = 1
+    ndimage.gaussian_filter(roi_smo, sigma, output=tmp, mode="nearest", truncate=4.0)
+    roi_smo, tmp = tmp, roi_smo
+  smo[roi] = roi_smo
+  DxW[roi], DyW[roi] = np.gradient(roi_smo, 1)
 
   return DxW, DyW, smo
 
-def interp_functions(img, smo, DxW, DyW):
+class ImageSampler:
+  '''Interpolate an image at arrays of (x, y) coordinates
+  Spline coefficients are prefiltered once, so that the sampler can be
+  built once per image and queried many times. Points outside the image
+  take the value of the nearest border pixel.
+  Parameters
+  ----------
+  img : np.array
+    2D image
+  order : int
+    spline order: 1 for bilinear, 3 for cubic interpolation
+  '''
+
+  def __init__(self, img, order=1):
+    self.order = order
+    self.shape = img.shape
+    img = np.asarray(img, dtype=float)
+    if order > 1:
+      self.coeffs = ndimage.spline_filter(img, order=order, mode="nearest")
+    else:
+      self.coeffs = img
+
+  def __call__(self, x, y):
+    '''Sample the image at coordinates x, y (arrays of any matching shape)'''
+    x, y = np.broadcast_arrays(x, y)
+    coords = np.array([
+      np.clip(y, 0, self.shape[0] - 1).ravel(),
+      np.clip(x, 0, self.shape[1] - 1).ravel()
+    ])
+    values = ndimage.map_coordinates(
+      self.coeffs, coords, order=self.order, mode="nearest", prefilter=False)
+    return values.reshape(x.shape)
+
+def interp_functions(img, smo, DxW, DyW, order=1):
   '''Interpolate function for image and gradients'''
-  X, Y = np.arange(0, img.shape[1], 1), np.arange(0, img.shape[0], 1)
-  fni = interp2d(X, Y, img)
-  fng = interp2d(X, Y, smo)
-  fnx = interp2d(X, Y, DyW)
-  fny = interp2d(X, Y, DxW)
+  fni = ImageSampler(img, order)
+  fng = ImageSampler(smo, order)
+  fnx = ImageSampler(DyW, order)
+  fny = ImageSampler(DxW, order)
   return fni, fng, fnx, fny
 
-def get_profile_lines(pp, fng, fnx, fny, profile_length=30, data_steps=20, total_steps=40, step_length=0.5):
-  '''Compute profile lines'''
-  end = polygon_normals(pp, profile_length=profile_length)
-  qq = pp.copy()
+def get_profile_lines(
+  pp, fng, fnx, fny, profile_length=30, data_steps=20, total_steps=40, step_length=0.5,
+  normals=None
+):
+  '''Compute profile lines
+  All profiles are traced together following the gradient of the smoothed
+  image. A profile stops when the grey level increases; profiles with less
+  than 3 samples are dropped. The remaining profiles are extended as straight
+  lines up to total_steps samples.
+  Parameters
+  ----------
+  pp : np.array
+    contour coordinates, shape (n, 2)
+  fng, fnx, fny : callable
+    functions evaluating the smoothed image and its x and y gradients
+    at arrays of x and y coordinates
+  normals : np.array
+    if provided, cr.polygon_normals(pp, profile_length) already computed
+  Returns
+  -------
+  profile_lines : list of np.array
+    profile coordinates, each of shape (total_steps, 2)
+  profile_indices : list of int
+    index in pp of the starting point of each profile
+  '''
+  end = cr.polygon_normals(pp, profile_length=profile_length) if normals is None else normals
 
   # 0.25 px inset
-  for i, start in enumerate(qq):
-    norm = np.sum((end[i] - start)**2)**0.5
-
-    inset = 0.25/norm
-
-    qq[i] = start*(1-inset) + end[i]*inset
-
-  # profile lines
-  profile_indices = []
-  profile_lines = []
-  for index, q_new in enumerate(qq):
-    n_samples = 0
-    xy = np.zeros((total_steps - 1, 2))
-    val0 = fng(*q_new)[0]
-    for _ in range(data_steps):
-      d = np.array([fnx(*q_new)[0], fny(*q_new)[0]])
-      d = step_length * d / np.linalg.norm(d)
-      q_new = np.array([q_new[0]-d[0], q_new[1]-d[1]])
-      val = fng(*q_new)[0]
-      if val > val0:
-        break
-      val0 = val
-      xy[n_samples, :] = q_new
-      n_samples += 1
-    if n_samples < 3:
-      continue
-
-    # extend
-    x, y = xy[n_samples-1]
-    x0, y0 = xy[n_samples-2]
-    new_steps = total_steps - n_samples - 1
-    for i in range(2, new_steps + 2):
-      xy[n_samples+i-2] = (x-x0)*i + x0, (y-y0)*i + y0
-
-    # add back start point
-    xy = np.array([pp[index], *xy])
-
-    # append to the list of profiles
-    profile_lines.append(xy)
-    profile_indices.append(index)
-
-  return profile_lines, profile_indices
-
-def get_profile_levels(profile_lines, fni, total_steps):
-  '''Compute grey levels along profiles'''
-  profile_levels = []
-  for xy in profile_lines:
-    gr = np.zeros(total_steps)
-    for i,(x,y) in enumerate(xy):
-      gr[i] = fni(x,y)[0]
-    profile_levels.append(gr)
-  return profile_levels
-
-def extract_image_profiles(img, smo, DxW, DyW, pp):
+  inset = 0.25/np.sqrt(np.sum((end - pp)**2, axis=1))
+  q_new = pp*(1 - inset[:, np.newaxis]) + end*inset[:, np.newaxis]
+
+  # profile lines: advance all active profiles one step at a time
+  xy = np.zeros((len(pp), total_steps - 1, 2))
+  n_samples = np.zeros(len(pp), dtype=int)
+  active = np.arange(len(pp))
+  val0 = fng(q_new[:, 0], q_new[:, 1])
+  for step in range(data_steps):
+    if len(active) == 0:
+      break
+    q = q_new[active]
+    d = np.stack([fnx(q[:, 0], q[:, 1]), fny(q[:, 0], q[:, 1])], axis=1)
+    d = step_length * d / np.linalg.norm(d, axis=1)[:, np.newaxis]
+    q = q - d
+    val = fng(q[:, 0], q[:, 1])
+    going_down = ~(val > val0[active])
+    active = active[going_down]
+    q_new[active] = q[going_down]
+    val0[active] = val[going_down]
+    xy[active, step] = q[going_down]
+    n_samples[active] += 1
+
+  valid = np.flatnonzero(n_samples >= 3)
+  xy = xy[valid]
+  n_samples = n_samples[valid, np.newaxis]
+
+  # extend
+  rows = np.arange(len(valid))
+  last = xy[rows, n_samples[:, 0] - 1]
+  prev = xy[rows, n_samples[:, 0] - 2]
+  steps = np.arange(total_steps - 1)
+  i = steps - n_samples + 2
+  extension = (last - prev)[:, np.newaxis, :]*i[:, :, np.newaxis] + prev[:, np.newaxis, :]
+  xy = np.where((steps >= n_samples)[:, :, np.newaxis], extension, xy)
+
+  # add back start point
+  xy = np.concatenate([pp[valid, np.newaxis, :], xy], axis=1)
+
+  return list(xy), valid.tolist()
+
+def get_profile_levels(profile_lines, fni, total_steps, out=None):
+  '''Compute grey levels along profiles
+  Returns a matrix of shape (n_profiles, total_steps). If out is provided,
+  the levels are written into it'''
+  if out is None:
+    out = np.empty((len(profile_lines), total_steps))
+  if len(profile_lines) == 0:
+    return out
+  xy = np.asarray(profile_lines)[:, :total_steps]
+  out[:] = fni(xy[:, :, 0], xy[:, :, 1])
+  return out
+
+def extract_image_profiles(fni, fng, fnx, fny, pp, total_steps=40):
   '''
   fni: interpolating function for image
   fng: interpolating function for gaussian smoothed image
   fnx: interpolating function for x gradient
   fny: interpolating function for y gradient
   '''
-  total_steps = 40
-  fni, fng, fnx, fny = interp_functions(img, smo, DxW, DyW)
   profile_lines, profile_indices = get_profile_lines(pp, fng, fnx, fny, total_steps=total_steps)
   profile_levels = get_profile_levels(profile_lines, fni, total_steps)
   return profile_lines, profile_levels, profile_indices
 
-def molecular_layer_thickness(profile_levels):
+def local_maxima(x):
+  '''Find the local maxima along the rows of a matrix, as
+  scipy.signal.find_peaks does for each row: the ends of the rows are
+  excluded, and the middle (rounded down) of flat peaks is returned
+  Parameters
+  ----------
+  x : np.array
+    matrix of shape (n, m)
+  Returns
+  -------
+  rows, cols : np.array
+    coordinates of the maxima, sorted by row and column
+  '''
+  m = x.shape[1]
+  cols = np.arange(m)
+
+  # for each sample, first following sample with a different value
+  # (or the last sample)
+  change = np.where(x[:, 1:] != x[:, :-1], cols[1:], m - 1)
+  ahead = np.minimum.accumulate(change[:, ::-1], axis=1)[:, ::-1]
+
+  rise = x[:, 1:m-1] > x[:, :m-2]
+  ahead = ahead[:, 1:m-1]
+  fall = np.take_along_axis(x, ahead, axis=1) < x[:, 1:m-1]
+  rows, start = np.nonzero(rise & fall)
+  start = start + 1
+  return rows, (start + ahead[rows, start - 1] - 1)//2
+
+def peak_prominences(x, rows, cols):
+  '''Prominence of peaks along the rows of a matrix, as computed by
+  scipy.signal.peak_prominences for each row'''
+  xr = x[rows]
+  peak = xr[np.arange(len(rows)), cols][:, np.newaxis]
+  index = np.arange(x.shape[1])
+  p = cols[:, np.newaxis]
+
+  # the bases extend up to the nearest higher samples on each side
+  higher = xr > peak
+  left = np.where(higher & (index < p), index, -1).max(axis=1, initial=-1)
+  right = np.where(higher & (index > p), index, x.shape[1]).min(axis=1, initial=x.shape[1])
+  left_min = np.where((index > left[:, np.newaxis]) & (index <= p), xr, np.inf).min(axis=1)
+  right_min = np.where((index < right[:, np.newaxis]) & (index >= p), xr, np.inf).min(axis=1)
+  return peak[:, 0] - np.maximum(left_min, right_min)
+
+def molecular_layer_thickness(profile_levels, prominence=0.05, level=0.5):
   '''
   Returns an array of thicknesses, and an array of indices
   for the profiles to which those thicknesses correspond.
   The thickness value is the number of profile samples
   from the beginning of the profile to the point where
-  the molecular layer boundary occurs.
+  the molecular layer boundary occurs: the first peak of
+  negative gradient with at least the given prominence, or the
+  second if the grey level at the first is above level.
+  All profiles are processed together as a matrix of shape
+  (n_profiles, total_steps).
   '''
-  ind = []
-  th = []
-  for i, prl in enumerate(profile_levels):
-    gprl = np.gradient(prl)
-    jj = find_peaks(-gprl, prominence=0.05)[0]
-    if len(jj) == 0:
-      continue
-    j = jj[0]
-    if prl[j]>0.5 and len(jj)>1:
-      j = jj[1]
-    ind.append(i)
-    th.append(j)
-
-  return np.array(th), ind
+  profile_levels = np.asarray(profile_levels, dtype=float)
+  if profile_levels.size == 0:
+    return np.array([], dtype=int), []
+
+  ngrad = -np.gradient(profile_levels, axis=1)
+  rows, cols = local_maxima(ngrad)
+  keep = peak_prominences(ngrad, rows, cols) >= prominence
+  rows, cols = rows[keep], cols[keep]
+
+  # first and second peak of each profile
+  ind, first = np.unique(rows, return_index=True)
+  second = first + 1
+  has_second = second < len(rows)
+  has_second[has_second] = rows[second[has_second]] == ind[has_second]
+
+  th = cols[first]
+  use_second = has_second & (profile_levels[ind, th] > level)
+  th[use_second] = cols[second[use_second]]
+
+  return th, ind.tolist()
 
 #--------------------------------------------------------#
 #                                                        #
@@ -240,7 +371,13 @@ def compute_thickness(
   scale_row,
   cb_mid_row,
   name,
-  img_path=None
+  img_path=None,
+  interp_order=1,
+  roi_margin=None,
+  cache=None,
+  cache_gradients=False,
+  profiles_path=None,
+  img=None
 ):
   '''Compute thickness of the molecular layer
   from the image and the cerebellum contour
@@ -254,95 +391,244 @@ def compute_thickness(
     name of the image
   img_path : str
     path to the image
+  interp_order : int
+    spline order used to sample the image and its gradients:
+    1 for bilinear, 3 for cubic interpolation
+  roi_margin : int
+    if provided, the image is cropped to the bounding box of the contour
+    plus this margin (in px) before any filtering, which saves time and
+    memory when the cerebellum covers a small part of the slide. The
+    margin should be larger than the smoothing radius (~15 px); with a
+    margin of 64 px thicknesses differ from those computed on the whole
+    image only through the local contrast equalisation
+  cache : image_cache.ImageCache
+    if provided, the preprocessed image is read from (or saved to)
+    this cache, keyed by the content of the image file and the
+    preprocessing parameters
+  cache_gradients : bool
+    also cache the smoothed image and its gradients, which depend on
+    the contour
+  profiles_path : str
+    if provided, per-profile results are saved to this .npz file, with
+    one column per field: contour (index of the polygon in the contour),
+    x and y (start of the profile in image coordinates), thickness (mm)
+    and boundary (index of the profile sample at the molecular layer
+    boundary)
+  img : np.array
+    if provided, the image already read from img_path, for example by a
+    background thread
   Returns
   -------
   thickness : float
     thickness of the molecular layer
   '''
 
-  # set matplotlib background (required for making the mask)
-  matplotlib.use('agg')
-  if os.path.exists(img_path):
-    img = load_image(img_path)
-  else:
-    print("WARNING: No image file at path", img_path)
-    return
+  prepared = prepare_thickness(
+    scale_row, cb_mid_row, name, img_path, interp_order, roi_margin, cache,
+    cache_gradients, img)
+  if prepared is None:
+    return None
+  profiles = trace_profiles(prepared)
+  measured = profile_thicknesses(prepared, profiles)
+  if measured is None:
+    # the subject is kept in the results, without thickness
+    return "%s,nan,nan,nan\n"%name
+  thickness_array = measured["thickness"]
+
+  if profiles_path is not None:
+    np.savez(
+      profiles_path,
+      contour=np.asarray(profiles["contours"], dtype=np.int32)[measured["profiles"]],
+      x=measured["xy"][:, 0, 0],
+      y=measured["xy"][:, 0, 1],
+      thickness=thickness_array,
+      boundary=np.asarray(measured["boundary"], dtype=np.int32)
+    )
+
+  log.info(
+    "%s thickness median %s mean %s std %s", name,
+    np.median(thickness_array),
+    np.mean(thickness_array),
+    np.std(thickness_array)
+  )
+
+  csv = "%s,%g,%g,%g\n"%(
+    name,
+    np.median(thickness_array),
+    np.mean(thickness_array),
+    np.std(thickness_array)
+  )
+  return csv
+
+def prepare_thickness(
+  scale_row, cb_mid_row, name, img_path, interp_order=1, roi_margin=None,
+  cache=None, cache_gradients=False, img=None
+):
+  '''Steps of compute_thickness which do not depend on the profile
+  parameters: read and preprocess the image, make the mask and compute
+  the image gradients. Parameters as for compute_thickness
+  Returns
+  -------
+  dict or None
+    scale_row, img_width (width of the whole image), origin (of the
+    cropped image), min_length (distance between contour vertices, in svg
+    dimensions), artifacts (contour_artifacts.ContourArtifacts) and the
+    interpolation functions fni, fng, fnx and fny. None if the image or
+    the scale is missing
+  '''
+  if not os.path.exists(img_path):
+    log.warning("No image file at path %s", img_path)
+    return None
 
   if scale_row == 0:
-    print("No scale. Skipping")
+    log.warning("No scale. Skipping")
     return None
 
+  # look for the preprocessed image in the cache
+  cached = None
+  if cache is not None:
+    roi_params = None
+    if roi_margin is not None:
+      roi_params = (roi_margin, scale_row, cb_mid_row.bounds)
+    image_key = cache_key(file_hash(img_path), "image", roi_params)
+    cached = cache.load(image_key)
+  if cached is None:
+    if img is None:
+      with stage("read_image") as info:
+        img = read_image(img_path)
+        info["pixels"] = img.shape[0]*img.shape[1]
+    full_shape = img.shape[:2]
+  else:
+    full_shape = tuple(cached["shape"])
+
   try:
     # scale the contour to fit the dimensions of the image
-    scaled_mpoly = scale_contour_to_image(img, scale_row, cb_mid_row)
+    scaled_mpoly = scale_contour_to_image(full_shape[1], scale_row, cb_mid_row)
   except BaseException as err:
-    print("ERR2:", err)
+    log.error("ERR2: %s", err)
     return None
 
-  # length in svg dimensions
-  scaled_mpoly_length = scaled_mpoly.length * (1000/img.shape[1])
-  min_length = scaled_mpoly_length**0.3/10
+  # lengths are converted to mm using the width of the whole image
+  img_width = full_shape[1]
+
+  # crop the image to the contour, working in cropped coordinates
+  origin = np.zeros(2)
+  kernel_size = None
+  roi = (slice(None), slice(None))
+  if roi_margin is not None:
+    kernel_size = (full_shape[0]//8, full_shape[1]//8)
+    roi = contour_roi(full_shape, scaled_mpoly, roi_margin)
+    origin = np.array([roi[1].start, roi[0].start])
+    scaled_mpoly = affinity.translate(scaled_mpoly, xoff=-origin[0], yoff=-origin[1])
+  if cached is None:
+    with stage("preprocess_image") as info:
+      img = preprocess_image(img[roi], kernel_size)
+      info["pixels"] = img.size
+    if cache is not None:
+      cache.save(image_key, {"img": img, "shape": np.array(full_shape)})
+  else:
+    img = cached["img"]
 
-  # compute cb mask
+  # length in svg dimensions
+  scaled_mpoly_length = scaled_mpoly.length * (1000/img_width)
+  min_length = cr.thickness_min_length(scaled_mpoly_length)
 
   # form an array of polygons
   if isinstance(scaled_mpoly, shapely.geometry.Polygon):
     scaled_mpoly = [scaled_mpoly]
   else:
     scaled_mpoly = scaled_mpoly.geoms
-  mask = make_mask(img, scaled_mpoly)
-
-  # compute image gradients
-  DxW, DyW, smo = compute_image_gradients(img, mask)
 
-  # compute profiles
+  artifacts = ContourArtifacts(cb_mid_row, name, cache)
+  cached = None
+  if cache is not None and cache_gradients:
+    gradients_key = cache_key(image_key, "gradients", scale_row, artifacts.hash)
+    cached = cache.load(gradients_key)
+  if cached is None:
+    # compute cb mask
+    with stage("make_mask", pixels=img.size):
+      mask = make_mask(img, scaled_mpoly)
+
+    # compute image gradients
+    with stage("compute_image_gradients", pixels=img.size):
+      DxW, DyW, smo = compute_image_gradients(img, mask)
+    if cache is not None and cache_gradients:
+      cache.save(gradients_key, {"DxW": DxW, "DyW": DyW, "smo": smo})
+  else:
+    DxW, DyW, smo = cached["DxW"], cached["DyW"], cached["smo"]
+  fni, fng, fnx, fny = interp_functions(img, smo, DxW, DyW, order=interp_order)
+  return {
+    "scale_row": scale_row, "img_width": img_width, "origin": origin,
+    "min_length": min_length, "artifacts": artifacts,
+    "fni": fni, "fng": fng, "fnx": fnx, "fny": fny}
+
+def trace_profiles(prepared, profile_length=30, data_steps=20, total_steps=40, step_length=0.5):
+  '''Trace the profiles from the contour and extract their grey levels
+  Parameters
+  ----------
+  prepared : dict
+    result of prepare_thickness
+  profile_length, data_steps, total_steps, step_length
+    parameters of get_profile_lines
+  Returns
+  -------
+  dict
+    lines (coordinates of each profile), contours (index of the polygon
+    of each profile) and levels (grey levels, shape (n_profiles,
+    total_steps))
+  '''
+  fni, fng, fnx, fny = (prepared[f] for f in ("fni", "fng", "fnx", "fny"))
   profile_lines = []
-  profile_levels = []
-  profile_indices = []
-  pps = []
-  for sm in scaled_mpoly:
-    try:
-      pp = resample_contour(sm, img, min_length)
-    except BaseException as err:
-      print("ERR3:", err)
-      continue
-
-    # compute normal direction profiles
-    profile_length = 50
-    end = polygon_normals(pp, profile_length=profile_length)
-    pps.append(pp)
-
+  profile_contours = []
+  with stage("profile_tracing") as info:
+    # contours resampled in image coordinates, shared with other stages
+    contours, normals = prepared["artifacts"].thickness_contours(
+      prepared["img_width"], prepared["scale_row"], prepared["origin"],
+      prepared["min_length"], profile_length)
+    for contour_index, (pp, end) in enumerate(zip(contours, normals)):
+      if len(pp) == 0:
+        continue
+      plin, _ = get_profile_lines(
+        pp, fng, fnx, fny, profile_length, data_steps, total_steps, step_length, normals=end)
+      profile_lines.extend(plin)
+      profile_contours.extend([contour_index]*len(plin))
+    info["profiles"] = len(profile_lines)
+
+  with stage("profile_levels", profiles=len(profile_lines)):
     # extract grey level profiles
-    ind0 = 0
-    plin, plev, pind = extract_image_profiles(img, smo, DxW, DyW, pp)
-    profile_lines.extend(plin)
-    profile_levels.extend(plev)
-    profile_indices.extend(np.array(pind) + ind0)
-    ind0 += len(pind)
-
-  # estimate molecular layer thickness
-  th, ind = molecular_layer_thickness(profile_levels)
-
-  thickness_array = []
-  try:
-    for i, _ in enumerate(th):
-      xy = profile_lines[ind[i]]
-      total_length = LineString(xy).length # length in image dimensions (px)
-      thickness_array.append(total_length*th/len(xy))
-  except BaseException as err:
-    print("ERROR:", err)
-    return
+    profile_levels = np.empty((len(profile_lines), total_steps))
+    get_profile_levels(profile_lines, fni, total_steps, out=profile_levels)
+  return {"lines": profile_lines, "contours": profile_contours, "levels": profile_levels}
 
-  print(
-    np.median(thickness_array) * (1000/img.shape[1]) * scale_row,
-    np.mean(thickness_array) * (1000/img.shape[1]) * scale_row,
-    np.std(thickness_array) * (1000/img.shape[1]) * scale_row
-  )
+def profile_thicknesses(prepared, profiles, prominence=0.05, level=0.5):
+  '''Thickness of the molecular layer along each profile
+  Parameters
+  ----------
+  prepared : dict
+    result of prepare_thickness
+  profiles : dict
+    result of trace_profiles
+  prominence, level : float
+    parameters of molecular_layer_thickness
+  Returns
+  -------
+  dict or None
+    thickness (mm), boundary (index of the profile sample at the
+    boundary), profiles (index of the profile) and xy (profile
+    coordinates in the whole image) of each profile where a boundary was
+    found. None if no boundary was found
+  '''
+  with stage("boundary_detection", profiles=len(profiles["lines"])):
+    # estimate molecular layer thickness
+    th, ind = molecular_layer_thickness(profiles["levels"], prominence, level)
+  if len(th) == 0:
+    log.error("no molecular layer boundary found")
+    return None
 
-  csv = "%s,%g,%g,%g\n"%(
-    name,
-    np.median(thickness_array) * (1000/img.shape[1]) * scale_row,
-    np.mean(thickness_array) * (1000/img.shape[1]) * scale_row,
-    np.std(thickness_array) * (1000/img.shape[1]) * scale_row
-  )
-  return csv
+  # thickness of each profile, from its length in image dimensions (px)
+  # profile coordinates are mapped back to the whole image
+  xy = np.asarray(profiles["lines"])[ind] + prepared["origin"]
+  total_length = np.sum(np.linalg.norm(np.diff(xy, axis=1), axis=2), axis=1)
+  thickness_array = (
+    total_length*th/xy.shape[1] * (1000/prepared["img_width"]) * prepared["scale_row"])
+  return {"thickness": thickness_array, "boundary": th, "profiles": ind, "xy": xy}
@@ -0,0 +1,441 @@
+'''Distributed processing of the gyral and thickness stages through a
+work queue
+
+A coordinator enqueues one task per specimen; workers on any machine
+lease tasks, compute them and push their results back; the results are
+finally merged into the derived csv files, in the order of 01_cb_data.csv
+whatever the order in which they were computed:
+  python work_queue.py enqueue QUEUE thickness [--roi-margin 64 ...]
+  python work_queue.py work QUEUE              (on each node, any number)
+  python work_queue.py status QUEUE
+  python work_queue.py merge QUEUE thickness
+A worker holds a lease on its task, renewed while it computes. If a worker
+dies, its lease expires and the task is leased again by another worker;
+a task whose computation fails or whose lease expires max_attempts times
+is recorded as failed, and skipped by the merge. A task may then be
+computed twice: the first result pushed is kept.
+
+QUEUE is opened by open_queue: a directory on a filesystem shared by the
+nodes (FileQueue). Other backends implement the methods of FileQueue
+(put, lease, renew, complete, fail, status, results). Paths given as
+stage options (annotation store, cache and profiles directories) must be
+valid on all nodes, and the clocks of the nodes synchronised.
+'''
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from image_cache import ImageCache
+from incremental_build import atomic_write, file_mode
+from run_report import configure_logging
+from specimen_executor import map_specimens
+
+log = logging.getLogger(__name__)
+
+# module and functions of each stage: tasks(**options) lists the arguments
+# of compute for each specimen, save(results) writes the derived files
+STAGES = {
+  "gyral": {
+    "module": "2_figure3_folial_width_perimeter", "tasks": "gyral_tasks",
+    "compute": "compute_gyral_measurements", "save": "save_gyral_measurements"},
+  "thickness": {
+    "module": "3_figure4_thickness", "tasks": "thickness_tasks",
+    "compute": "compute_subject_thickness", "save": "save_thicknesses"}
+}
+
+def _read_json(path):
+  '''Content of a json file, None if it does not exist or is being written'''
+  try:
+    with open(path, "r", encoding="utf-8") as file:
+      return json.load(file)
+  except (FileNotFoundError, ValueError):
+    return None
+
+def _create_json(path, value):
+  '''Write a json file only if it does not exist. Returns whether it was
+  written'''
+  directory = os.path.dirname(path)
+  fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+  try:
+    os.fchmod(fd, file_mode(path))
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+      json.dump(value, file)
+    # link fails if the file exists, including on network filesystems
+    os.link(tmp, path)
+    return True
+  except FileExistsError:
+    return False
+  finally:
+    os.unlink(tmp)
+
+def _remove(path):
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+
+class FileQueue:
+  '''Work queue in a directory of a shared filesystem
+  Each task, lease, result and failure is a json file, in the tasks,
+  leases, results and failed subdirectories. Leases are created with link,
+  and identified by a token: a worker renews its lease in a file of its
+  own token, and removes a lease by renaming it aside and checking that it
+  is still the lease it read, so that it never overwrites nor removes the
+  lease of another worker.
+  Parameters
+  ----------
+  root : str
+    directory of the queue, created if needed
+  max_attempts : int
+    number of times a task is leased before it is recorded as failed
+  '''
+
+  def __init__(self, root, max_attempts=3):
+    self.root = root
+    self.max_attempts = max_attempts
+    # token of each lease held by this queue
+    self.tokens = {}
+    for name in ("tasks", "leases", "results", "failed"):
+      os.makedirs(os.path.join(root, name), exist_ok=True)
+
+  def _path(self, kind, key):
+    return os.path.join(self.root, kind, key + ".json")
+
+  def put(self, key, task):
+    '''Add a task, unless it is already queued or done. Returns whether
+    it was added'''
+    if os.path.exists(self._path("results", key)) or os.path.exists(self._path("failed", key)):
+      return False
+    return _create_json(self._path("tasks", key), task)
+
+  def _renewal_path(self, key, token):
+    return self._path("leases", key) + f".{token}.renewal"
+
+  def _read_lease(self, key, path=None):
+    '''Lease of a task read from path (by default the lease file of the
+    task), with the expiry of its last renewal. None if there is no lease'''
+    lease = _read_json(path or self._path("leases", key))
+    if lease is not None:
+      renewal = _read_json(self._renewal_path(key, lease["token"]))
+      if renewal is not None:
+        lease["expires"] = renewal["expires"]
+    return lease
+
+  def _remove_lease(self, key, token, worker, expired=False):
+    '''Remove the lease of a task if it is still the lease with this
+    token and, if expired, it was not renewed since. Returns whether it was
+    removed'''
+    path = self._path("leases", key)
+    aside = path + f".{worker}.stale"
+    try:
+      os.rename(path, aside)
+    except FileNotFoundError:
+      return False
+    # another worker may have replaced or renewed the lease since it was read
+    lease = self._read_lease(key, aside)
+    if lease["token"] != token or (expired and lease["expires"] > time.time()):
+      try:
+        os.link(aside, path)
+      except FileExistsError:
+        # a lease was created while the file was aside: the task is now
+        # leased to its worker, and the worker of this one loses it
+        pass
+      os.remove(aside)
+      return False
+    os.remove(aside)
+    _remove(self._renewal_path(key, token))
+    return True
+
+  def _take_over(self, key, lease, worker):
+    '''Remove an expired lease, if no other worker did. Returns whether
+    this worker removed it'''
+    if not self._remove_lease(key, lease["token"], worker, expired=True):
+      return False
+    log.warning(
+      "lease of %s by %s ended without result (attempt %d)", key, lease["worker"],
+      lease["attempts"])
+    return True
+
+  def lease(self, worker, duration):
+    '''Lease the first available task
+    Parameters
+    ----------
+    worker : str
+      name of the worker
+    duration : float
+      duration of the lease (s), until renew is called
+    Returns
+    -------
+    key : str
+      key of the task, None if no task is available
+    task : dict
+      the task
+    '''
+    for name in sorted(os.listdir(os.path.join(self.root, "tasks"))):
+      if not name.endswith(".json"):
+        continue
+      key = name[:-5]
+      task = _read_json(self._path("tasks", key))
+      if task is None:
+        continue
+      attempts = 0
+      lease = self._read_lease(key)
+      if lease is None and os.path.exists(self._path("leases", key)):
+        # lease being renewed
+        continue
+      if lease is not None:
+        if lease["expires"] > time.time() or not self._take_over(key, lease, worker):
+          continue
+        attempts = lease["attempts"]
+        if attempts >= self.max_attempts:
+          self._record_failure(key, task, f"no result after {attempts} attempts")
+          continue
+      lease = {
+        "worker": worker, "token": uuid.uuid4().hex, "expires": time.time() + duration,
+        "attempts": attempts + 1}
+      if _create_json(self._path("leases", key), lease):
+        self.tokens[key] = lease["token"]
+        return key, task
+    return None, None
+
+  def _held_lease(self, key, worker):
+    '''Lease of a task if it is held by this worker, else None'''
+    lease = self._read_lease(key)
+    if lease is None or lease["token"] != self.tokens.get(key) or lease["worker"] != worker:
+      return None
+    return lease
+
+  def _set_expiry(self, key, worker, expires):
+    '''Change the expiry of the lease of a task held by this worker.
+    Returns False if the worker lost it'''
+    lease = self._held_lease(key, worker)
+    if lease is None:
+      return False
+    renewal = self._renewal_path(key, lease["token"])
+    atomic_write(renewal, lambda file: json.dump({"expires": expires}, file))
+    if self._held_lease(key, worker) is None:
+      # taken over while the renewal was written
+      _remove(renewal)
+      return False
+    return True
+
+  def renew(self, key, worker, duration):
+    '''Extend the lease of a task. Returns False if the worker lost it'''
+    return self._set_expiry(key, worker, time.time() + duration)
+
+  def _release(self, key, worker):
+    token = self.tokens.pop(key, None)
+    if token is not None:
+      self._remove_lease(key, token, worker)
+
+  def complete(self, key, worker, result):
+    '''Push the result of a task. The first result of a task is kept'''
+    _create_json(self._path("results", key), {"worker": worker, "result": result})
+    _remove(self._path("tasks", key))
+    self._release(key, worker)
+
+  def _record_failure(self, key, task, error):
+    log.error("task %s failed: %s", key, error)
+    _create_json(self._path("failed", key), {"task": task, "error": error})
+    _remove(self._path("tasks", key))
+
+  def fail(self, key, worker, error):
+    '''Report that the computation of a task failed: the task is leased
+    again, or recorded as failed after max_attempts'''
+    lease = self._held_lease(key, worker)
+    if lease is not None and lease["attempts"] >= self.max_attempts:
+      self._record_failure(key, _read_json(self._path("tasks", key)), error)
+      self._release(key, worker)
+    elif lease is not None:
+      log.warning("task %s failed, will be retried: %s", key, error)
+      # expire the lease, keeping the count of attempts
+      self._set_expiry(key, worker, 0)
+      self.tokens.pop(key, None)
+
+  def status(self):
+    '''Number of pending, leased, done and failed tasks'''
+    def keys(kind):
+      return {f[:-5] for f in os.listdir(os.path.join(self.root, kind)) if f.endswith(".json")}
+    tasks = keys("tasks")
+    leased = tasks & keys("leases")
+    return {
+      "pending": len(tasks - leased), "leased": len(leased),
+      "done": len(keys("results")), "failed": len(keys("failed"))}
+
+  def results(self, prefix=""):
+    '''Results of the tasks whose key starts with prefix, by key'''
+    results = {}
+    for name in os.listdir(os.path.join(self.root, "results")):
+      if name.startswith(prefix) and name.endswith(".json"):
+        results[name[:-5]] = _read_json(self._path("results", name[:-5]))["result"]
+    return results
+
+def open_queue(location, max_attempts=3):
+  '''Work queue at a location: a directory of a shared filesystem'''
+  return FileQueue(location, max_attempts)
+
+def task_key(stage, row):
+  '''Key of the task of a specimen, ordered as the rows of 01_cb_data.csv'''
+  return f"{stage}-{row:05d}"
+
+def stage_tasks(stage, options):
+  '''Arguments of the compute function of a stage for each specimen.
+  options are the keyword arguments of the tasks function of the stage,
+  with cache_dir and cache_size in place of the cache'''
+  module = importlib.import_module(STAGES[stage]["module"])
+  options = dict(options)
+  cache_dir = options.pop("cache_dir", None)
+  cache_size = options.pop("cache_size", 8)
+  if cache_dir:
+    options["cache"] = ImageCache(cache_dir, int(cache_size*2**30))
+  return getattr(module, STAGES[stage]["tasks"])(**options)
+
+def enqueue(queue, stage, options):
+  '''Enqueue a task for each specimen of a stage. Returns the number of
+  tasks added'''
+  added = 0
+  for task in stage_tasks(stage, options):
+    added += queue.put(
+      task_key(stage, task[0]), {"stage": stage, "row": task[0], "options": options})
+  return added
+
+def _keep_leased(queue, key, worker, duration, done):
+  '''Renew a lease until done is set'''
+  while not done.wait(duration/3):
+    if not queue.renew(key, worker, duration):
+      log.warning("lost the lease of %s", key)
+      return
+
+def work(queue, worker=None, lease_duration=600, poll=10):
+  '''Compute tasks until the queue is empty
+  Parameters
+  ----------
+  queue : FileQueue
+    work queue
+  worker : str
+    name of the worker, by default host name and process id
+  lease_duration : float
+    duration of the leases (s). Leases are renewed every third of it
+    while a task is computed
+  poll : float
+    while all remaining tasks are leased by other workers, wait this long
+    (s) before looking for expired leases
+  Returns
+  -------
+  int
+    number of tasks computed
+  '''
+  worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+  tasks = {}
+  computed = 0
+  while True:
+    key, task = queue.lease(worker, lease_duration)
+    if key is None:
+      status = queue.status()
+      if status["pending"] + status["leased"] == 0:
+        return computed
+      time.sleep(poll)
+      continue
+    stage = task["stage"]
+    options_key = json.dumps([stage, task["options"]], sort_keys=True)
+    if options_key not in tasks:
+      tasks[options_key] = {t[0]: t for t in stage_tasks(stage, task["options"])}
+    func = getattr(importlib.import_module(STAGES[stage]["module"]), STAGES[stage]["compute"])
+
+    done = threading.Event()
+    heartbeat = threading.Thread(
+      target=_keep_leased, args=(queue, key, worker, lease_duration, done), daemon=True)
+    heartbeat.start()
+    try:
+      results, errors = map_specimens(func, [tasks[options_key][task["row"]]], labels=[key])
+    finally:
+      done.set()
+      heartbeat.join()
+    if errors:
+      queue.fail(key, worker, errors[0][1])
+    else:
+      queue.complete(key, worker, results[0])
+      computed += 1
+
+def merge(queue, stage):
+  '''Write the derived files of a stage from the results in the queue, in
+  the order of the specimens. Returns False, without writing, if some
+  tasks of the stage are not finished'''
+  pending = [
+    f for f in os.listdir(os.path.join(queue.root, "tasks"))
+    if f.startswith(stage + "-") and f.endswith(".json")]
+  if pending:
+    log.error("%d %s tasks are not finished", len(pending), stage)
+    return False
+  results = queue.results(stage + "-")
+  module = importlib.import_module(STAGES[stage]["module"])
+  getattr(module, STAGES[stage]["save"])([results[key] for key in sorted(results)])
+  return True
+
+def main(argv=None):
+  '''Command line interface'''
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument(
+    "--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  enqueue_parser = subparsers.add_parser("enqueue", help="enqueue the tasks of a stage")
+  enqueue_parser.add_argument("queue")
+  enqueue_parser.add_argument("stage", choices=list(STAGES))
+  enqueue_parser.add_argument("--annotations", default=None)
+  enqueue_parser.add_argument("--cache-dir", default=None)
+  enqueue_parser.add_argument("--cache-size", type=float, default=8)
+  enqueue_parser.add_argument("--roi-margin", type=int, default=None, help="thickness only")
+  enqueue_parser.add_argument("--cache-gradients", action="store_true", help="thickness only")
+  enqueue_parser.add_argument("--profiles-dir", default=None, help="thickness only")
+
+  work_parser = subparsers.add_parser("work", help="compute tasks until the queue is empty")
+  work_parser.add_argument("queue")
+  work_parser.add_argument("--worker", default=None, help="name of the worker")
+  work_parser.add_argument(
+    "--lease", type=float, default=600, help="duration of the leases in s (default: 600)")
+  work_parser.add_argument(
+    "--max-attempts", type=int, default=3,
+    help="attempts before a task is recorded as failed (default: 3)")
+  work_parser.add_argument("--poll", type=float, default=10)
+
+  status_parser = subparsers.add_parser("status", help="count the tasks")
+  status_parser.add_argument("queue")
+
+  merge_parser = subparsers.add_parser("merge", help="write the derived csv files")
+  merge_parser.add_argument("queue")
+  merge_parser.add_argument("stage", choices=list(STAGES))
+  args = parser.parse_args(argv)
+  configure_logging(args.log_level)
+
+  if args.command == "enqueue":
+    options = {"annotations": args.annotations and os.path.abspath(args.annotations)}
+    if args.cache_dir:
+      options.update(cache_dir=os.path.abspath(args.cache_dir), cache_size=args.cache_size)
+    if args.stage == "thickness":
+      options.update(
+        roi_margin=args.roi_margin, cache_gradients=args.cache_gradients,
+        profiles_dir=args.profiles_dir and os.path.abspath(args.profiles_dir))
+    added = enqueue(open_queue(args.queue), args.stage, options)
+    log.info("%d tasks added", added)
+  elif args.command == "work":
+    computed = work(
+      open_queue(args.queue, args.max_attempts), args.worker, args.lease, args.poll)
+    log.info("%d tasks computed", computed)
+  elif args.command == "status":
+    print(json.dumps(open_queue(args.queue).status()))
+  elif args.command == "merge":
+    return 0 if merge(open_queue(args.queue), args.stage) else 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())